@@ -9,11 +9,27 @@ http://sopel.chat/
 
 from __future__ import print_function
 from sopel.module import commands, priority
-from random import randint, seed
+from random import random, seed
+from collections import Counter
+from heapq import nsmallest
+from math import exp, lgamma, log
+from numbers import Integral
+import json
+import sqlite3
 import time
+import os
 import os.path
-from sopel.modules.calc import calculate
+import sys
+import threading
 import re
+try:
+    from random import choices
+except ImportError:  # py2
+    choices = None
+if sys.version_info.major < 3:
+    from Queue import Queue, Empty, Full
+else:
+    from queue import Queue, Empty, Full
 
 seed()
 
@@ -25,6 +41,45 @@ def setup(bot):
         bot.config.parser.set('dicelog', 'logdir', '.')
     if not bot.config.has_option('dicelog', 'campaigns'):
         bot.config.parser.set('dicelog', 'campaigns', '')
+    if not bot.config.has_option('dicelog', 'max_dice'):
+        bot.config.parser.set('dicelog', 'max_dice', '1000000')
+    if not bot.config.has_option('dicelog', 'max_listed'):
+        bot.config.parser.set('dicelog', 'max_listed', '40')
+    if not bot.config.has_option('dicelog', 'max_repeat'):
+        bot.config.parser.set('dicelog', 'max_repeat', '20')
+    if not bot.config.has_option('dicelog', 'log_buffer'):
+        bot.config.parser.set('dicelog', 'log_buffer', '50')
+    if not bot.config.has_option('dicelog', 'log_flush_interval'):
+        bot.config.parser.set('dicelog', 'log_flush_interval', '5')
+    if not bot.config.has_option('dicelog', 'log_max_bytes'):
+        bot.config.parser.set('dicelog', 'log_max_bytes', '0')
+    if not bot.config.has_option('dicelog', 'log_backups'):
+        bot.config.parser.set('dicelog', 'log_backups', '5')
+    if not bot.config.has_option('dicelog', 'history_db'):
+        bot.config.parser.set('dicelog', 'history_db', 'rolls.db')
+    log = lambda message: bot.debug('dicelog', message, 'warning')
+    bot.memory['dicelog_logs'] = CampaignLogs(
+        bot.config.dicelog.logdir, bot.config.dicelog.campaigns.split(','),
+        buffer_lines=int(bot.config.dicelog.log_buffer),
+        flush_interval=float(bot.config.dicelog.log_flush_interval),
+        max_bytes=int(bot.config.dicelog.log_max_bytes),
+        backups=int(bot.config.dicelog.log_backups), log=log)
+    history = None
+    if bot.config.dicelog.history_db:
+        history = RollHistory(os.path.join(bot.config.dicelog.logdir,
+                                           os.path.expanduser(bot.config.dicelog.history_db)),
+                              log=log)
+    bot.memory['dicelog_history'] = history
+
+
+def shutdown(bot):
+    """Writes out the buffered rolls and closes the campaign logs."""
+    logs = bot.memory.get('dicelog_logs')
+    if logs is not None:
+        logs.close()
+    history = bot.memory.get('dicelog_history')
+    if history is not None:
+        history.close()
 
 
 def configure(config):
@@ -32,6 +87,19 @@ def configure(config):
         will ask the user to blacklist one or the other. If dicelog is kept, it
         asks for a directory to store the logs, and also for a list of campaigns
         to recognize.
+
+        | [dicelog] | example | purpose |
+        | --------- | ------- | ------- |
+        | logdir | . | Where the campaign logs are stored |
+        | campaigns | mycampaign | The campaigns to log rolls for |
+        | max_dice | 1000000 | Max. number of dice rolled by a single command |
+        | max_listed | 40 | Larger pools are summarized with counts per face |
+        | max_repeat | 20 | Max. number of times a roll can be repeated with N#formula |
+        | log_buffer | 50 | Max. rolls held in memory before the logs are written |
+        | log_flush_interval | 5 | Seconds between writes of the buffered rolls |
+        | log_max_bytes | 0 | Size at which a log is rotated, 0 to never rotate |
+        | log_backups | 5 | Number of rotated logs to keep |
+        | history_db | rolls.db | Index of logged rolls in logdir, empty to disable |
     """
     which = config.option("This module conflicts with the default dice module. Should I disable it and to allow this one to run", True)
     module = "dice" if which else "dicelog"
@@ -59,9 +127,14 @@ def dicelog(bot, trigger):
     """
     .dice [logfile] <formula>  - Rolls dice using the XdY format, also does
     basic math and drop lowest (XdYvZ). Saves result in logfile if given.
+    .dice [logfile] N#<formula>  - Rolls a formula N times, also N x <formula>.
+    .dice stats <formula> [>=N]  - Gives the odds of a formula, optionally
+    the probability of rolling at least N.
     """
     if not trigger.group(2):
         return bot.reply('You have to specify the dice you wanna roll.')
+    if trigger.group(2).lower().startswith('stats '):
+        return diceStats(bot, trigger.group(2)[6:])
 
     # extract campaign
     if trigger.group(2).startswith('['):
@@ -71,86 +144,798 @@ def dicelog(bot, trigger):
         rollStr = trigger.group(2).strip()
     campaign = campaign.strip()
     rollStr = rollStr.strip()
-    # prepare string for mathing
-    arr = rollStr.lower().replace(' ', '')
-    arr = arr.replace('-', ' - ').replace('+', ' + ').replace('/', ' / ')
-    arr = arr.replace('*', ' * ').replace('(', ' ( ').replace(')', ' ) ')
-    arr = arr.replace('^', ' ^ ').replace('()', '').split(' ')
-    full_string, calc_string = '', ''
-
-    for segment in arr:
-        # check for dice
-        result = re.search("([0-9]+m)?([0-9]*d[0-9]+)(v[0-9]+)?", segment)
-        if result:
-            # detect droplowest
-            if result.group(3) is not None:
-                #check for invalid droplowest
-                dropLowest = int(result.group(3)[1:])
-                # or makes implied 1dx to be evaluated in case of dx being typed
-                if (dropLowest >= int(result.group(2).split('d')[0] or 1)):
-                    bot.reply('You\'re trying to drop too many dice.')
-                    return
-            else:
-                dropLowest = 0
-
-            # on to rolling dice!
-            value, drops = '(', ''
-            # roll...
-            dice = rollDice(result.group(2))
-            for i in range(0, len(dice)):
-                # format output
-                if i < dropLowest:
-                    if drops == '':
-                        drops = '[+'
-                    drops += str(dice[i])
-                    if i < dropLowest - 1:
-                        drops += '+'
-                    else:
-                        drops += ']'
-                else:
-                    value += str(dice[i])
-                    if i != len(dice) - 1:
-                        value += '+'
-            no_dice = False
-            value += drops + ')'
+    shownStr = rollStr
+    times = 1
+    repeat = repeat_regex.match(rollStr)
+    if repeat:
+        times, rollStr = int(repeat.group(1)), repeat.group(2).strip()
+        if not 1 <= times <= int(bot.config.dicelog.max_repeat):
+            return bot.reply('You can repeat a roll at most %s times.'
+                             % bot.config.dicelog.max_repeat)
+    try:
+        formula = compileFormula(normalizeFormula(rollStr))
+    except ValueError as e:
+        return bot.reply(str(e))
+    if sum(pool.rolls for pool in formula.pools) * times > int(bot.config.dicelog.max_dice):
+        return bot.reply('You\'re trying to roll too many dice.')
+
+    rolled = []
+    try:
+        if times == 1:
+            results = [formula.evaluate(int(bot.config.dicelog.max_listed), rolled)]
+            rolled = [rolled]
         else:
-            value = segment
-        full_string += value
-    # and repeat
-
-    # replace, split and join to exclude dropped dice from the math.
-    result = calculate(''.join(
-                full_string.replace('[', '#').replace(']', '#').split('#')[::2]))
-    if result == 'Sorry, no result.':
-        bot.reply('Calculation failed, did you try something weird?')
-    elif(no_dice):
+            results = formula.evaluateMany(int(bot.config.dicelog.max_listed), times, rolled)
+        shownResults = [formatResult(value) for value, full_string in results]
+    except (ArithmeticError, ValueError):
+        return bot.reply('Calculation failed, did you try something weird?')
+    if not formula.pools:
         bot.reply('For pure math, you can use .c '
-                     + rollStr + ' = ' + result)
+                     + rollStr + ' = ' + shownResults[0])
     else:
-        response = 'You roll ' + rollStr + ': ' + full_string + ' = ' + result
-        bot.reply(response)
+        if times == 1:
+            value, full_string = results[0]
+            bot.reply('You roll ' + rollStr + ': ' + full_string + ' = ' + shownResults[0])
+        else:
+            for line in packResults('You roll ' + shownStr + ': ', results):
+                bot.reply(line)
         campaign = campaign.strip().lower()
         if campaign:
-            if campaign in bot.config.dicelog.campaigns.split(','):
-                log = open(os.path.join(bot.config.dicelog.logdir, campaign + '.log'), 'a')
-                log.write("At <%s> %s rolled %s\n" % (time.ctime(), trigger.nick, response[9:]))
-                log.close()
+            logs = bot.memory['dicelog_logs']
+            if campaign in logs.campaigns:
+                now = time.time()
+                history = bot.memory['dicelog_history']
+                for (value, full_string), shown, pools in zip(results, shownResults, rolled):
+                    logs.write(campaign, "At <%s> %s rolled %s: %s = %s\n" % (
+                        time.ctime(now), trigger.nick, rollStr, full_string, shown))
+                    if history is not None:
+                        history.add(now, campaign, trigger.nick, rollStr, pools, value)
             else:
                 bot.reply("Didn't log because " + campaign + " is not listed as a campaign. sorry!")
 
 
-def rollDice(diceroll):
-    rolls = int(diceroll.split('d')[0] or 1)
-    size = int(diceroll.split('d')[1])
-    result = []  # dice results.
+def packResults(prefix, results):
+    """
+    Packs repeated rolls into as few lines as possible, showing how each
+    was rolled if they all fit on one line, and only their values if not.
+    """
+    parts = [full_string + ' = ' + formatResult(value) for value, full_string in results]
+    if len(prefix) + len(', '.join(parts)) > MAX_LINE_LENGTH:
+        parts = [formatResult(value) for value, full_string in results]
+    lines = [prefix]
+    for part in parts:
+        if lines[-1] not in ('', prefix) and len(lines[-1]) + 2 + len(part) > MAX_LINE_LENGTH:
+            lines.append('')
+        lines[-1] += (', ' if lines[-1] not in ('', prefix) else '') + part
+    return lines
+
+
+def rollCounts(rolls, size):
+    """
+    Rolls the given number of dice with the given number of faces in one
+    batched draw. Returns a Counter mapping each face to how many dice
+    rolled it.
+    """
+    if choices is not None:
+        return Counter(choices(range(1, size + 1), k=rolls))
+    return Counter([int(random() * size) + 1 for i in range(rolls)])
+
+
+def rollCountsBatch(rolls, size, times):
+    """
+    Rolls times pools of the given number of dice in one batched draw.
+    Returns a list of Counters of face counts, one for each pool.
+    """
+    if choices is not None:
+        faces = choices(range(1, size + 1), k=rolls * times)
+    else:
+        faces = [int(random() * size) + 1 for i in range(rolls * times)]
+    return [Counter(faces[i * rolls:(i + 1) * rolls]) for i in range(times)]
+
+
+def splitLowest(counts, drop):
+    """
+    Splits face counts into the counts of the kept dice and of the drop
+    lowest dice. Only the distinct faces rolled are sorted, not the dice.
+    """
+    kept = Counter(counts)
+    dropped = Counter()
+    for face in nsmallest(drop, kept) if drop else ():
+        taken = min(drop, kept[face])
+        dropped[face] = taken
+        kept[face] -= taken
+        drop -= taken
+        if not drop:
+            break
+    return +kept, dropped
+
+
+def expand(counts):
+    """Returns the sorted list of dice described by face counts."""
+    result = []
+    for face in sorted(counts):
+        result.extend([face] * counts[face])
+    return result
+
+
+def total(counts):
+    """Returns the sum of the dice described by face counts."""
+    return sum(face * count for face, count in counts.items())
+
+
+def summarize(kept, dropped):
+    """
+    Describes a large pool by how many dice rolled each face, e.g.
+    "1x16, 2x17, ..., 6x15 [dropped 1x3]".
+    """
+    summary = ', '.join('%dx%d' % (face, kept[face]) for face in sorted(kept))
+    if dropped:
+        summary += ' [dropped ' + ', '.join('%dx%d' % (face, dropped[face])
+                                            for face in sorted(dropped)) + ']'
+    return summary
+
+
+# N#formula or N x formula, to roll a formula N times
+repeat_regex = re.compile(r'^(\d+)\s*[#x](.+)$')
+# Replies are packed into lines of at most this many characters
+MAX_LINE_LENGTH = 400
+
+# Compiled formulas by normalized text
+formulas = {}
+FORMULA_CACHE_SIZE = 256
+# Exponents above this are refused rather than worked out
+MAX_EXPONENT = 1000
+# Whole results larger than this many bits are refused rather than worked out
+MAX_RESULT_BITS = 1024
+# Numbers typed with more digits than this are refused, as they are too
+# large to be a result anyway
+MAX_DIGITS = len(str(1 << MAX_RESULT_BITS))
+
+token_regex = re.compile(r'\s*(?:(\d*)d(\d+)(?:v(\d+))?|(\d+\.?\d*|\.\d+)|(\*\*|[-+*/%^()]))')
+
+
+class Number(object):
+    """A number in a formula, shown as it was typed."""
+
+    def __init__(self, text):
+        self.text = text
+        self.value = float(text) if '.' in text else int(text)
+
+    def evaluate(self, maxListed, rolled, draws):
+        return self.value, self.text
+
+    def terms(self, sign):
+        if not isinstance(self.value, int):
+            return None
+        return [(sign, self.value, 1, 0)]
+
+
+class Pool(object):
+    """An XdYvZ pool of dice, rolled in one batched draw."""
+
+    def __init__(self, rolls, size, drop):
+        self.rolls = rolls
+        self.size = size
+        self.drop = drop
+
+    def evaluate(self, maxListed, rolled, draws):
+        if draws is None:
+            counts = rollCounts(self.rolls, self.size)
+        else:
+            counts = draws[self].pop()
+        kept, dropped = splitLowest(counts, self.drop)
+        rolled.append((self.size, kept))
+        if self.rolls > maxListed:
+            value = '(' + summarize(kept, dropped) + ')'
+        else:
+            value = '(' + '+'.join(map(str, expand(kept)))
+            if dropped:
+                value += '[+' + '+'.join(map(str, expand(dropped))) + ']'
+            value += ')'
+        return total(kept), value
+
+    def terms(self, sign):
+        return [(sign, self.rolls, self.size, self.drop)]
+
+
+class Group(object):
+    """A parenthesized part of a formula."""
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    def evaluate(self, maxListed, rolled, draws):
+        value, shown = self.inner.evaluate(maxListed, rolled, draws)
+        return value, '(' + shown + ')'
+
+    def terms(self, sign):
+        return self.inner.terms(sign)
+
+
+class Negate(object):
+    """A unary minus."""
+
+    def __init__(self, operand):
+        self.operand = operand
+
+    def evaluate(self, maxListed, rolled, draws):
+        value, shown = self.operand.evaluate(maxListed, rolled, draws)
+        return -value, '-' + shown
+
+    def terms(self, sign):
+        return self.operand.terms(-sign)
+
+
+class Operation(object):
+    """A binary arithmetic operation."""
+
+    def __init__(self, operator, left, right):
+        self.operator = operator
+        self.left = left
+        self.right = right
+
+    def evaluate(self, maxListed, rolled, draws):
+        left, leftShown = self.left.evaluate(maxListed, rolled, draws)
+        right, rightShown = self.right.evaluate(maxListed, rolled, draws)
+        return (operate(self.operator, left, right),
+                leftShown + self.operator + rightShown)
+
+    def terms(self, sign):
+        if self.operator not in '+-':
+            return None
+        left = self.left.terms(sign)
+        right = self.right.terms(sign if self.operator == '+' else -sign)
+        if left is None or right is None:
+            return None
+        return left + right
+
+
+def operate(operator, left, right):
+    if operator == '+':
+        return left + right
+    if operator == '-':
+        return left - right
+    if operator == '*':
+        if isinstance(left, Integral) and isinstance(right, Integral) and \
+                left.bit_length() + right.bit_length() > MAX_RESULT_BITS + 1:
+            raise ValueError('Result too large')
+        return left * right
+    if operator == '/':
+        return float(left) / right
+    if operator == '%':
+        return left % right
+    # ^ and **
+    if abs(right) > MAX_EXPONENT:
+        raise ValueError('Exponent too large')
+    if isinstance(left, Integral) and isinstance(right, Integral) and right > 0 and \
+            (abs(left).bit_length() - 1) * right > MAX_RESULT_BITS:
+        raise ValueError('Result too large')
+    result = left ** right
+    if isinstance(result, complex):
+        raise ValueError('Complex result')
+    return checkSize(result)
+
+
+def checkSize(value):
+    """Returns value, raising ValueError if it is too large to show."""
+    if isinstance(value, Integral) and value.bit_length() > MAX_RESULT_BITS:
+        raise ValueError('Result too large')
+    return value
+
+
+class Formula(object):
+    """A compiled formula: its syntax tree and the dice pools in it."""
+
+    def __init__(self, root, pools):
+        self.root = root
+        self.pools = pools
+
+    def evaluate(self, maxListed, rolled=None):
+        """
+        Rolls the formula, returning its value and how it was rolled. The
+        (size, kept face counts) of each pool are appended to rolled.
+        """
+        if rolled is None:
+            rolled = []
+        value, shown = self.root.evaluate(maxListed, rolled, None)
+        return checkSize(value), shown
+
+    def evaluateMany(self, maxListed, times, rolled=None):
+        """
+        Rolls the formula times times, drawing the dice of each pool for
+        every roll in one batch. Returns a list of (value, how it was
+        rolled), and appends the pools of each roll to rolled.
+        """
+        draws = dict((pool, rollCountsBatch(pool.rolls, pool.size, times))
+                     for pool in self.pools)
+        results = []
+        for i in range(times):
+            pools = []
+            value, shown = self.root.evaluate(maxListed, pools, draws)
+            results.append((checkSize(value), shown))
+            if rolled is not None:
+                rolled.append(pools)
+        return results
+
+    def terms(self):
+        """
+        Returns the formula as (sign, rolls, size, drop) terms, a constant
+        being a pool of one one-faced die, or None if it is not a sum of
+        pools and whole numbers.
+        """
+        return self.root.terms(1)
+
+
+class FormulaParser(object):
+    """
+    Recursive descent parser for dice formulas:
+
+        sum     := product (('+' | '-') product)*
+        product := unary (('*' | '/' | '%') unary)*
+        unary   := '-' unary | '+' unary | power
+        power   := atom (('^' | '**') unary)?
+        atom    := XdY | XdYvZ | number | '(' sum ')'
+    """
+
+    def __init__(self, formula):
+        self.tokens = []
+        self.pools = []
+        position = 0
+        formula = formula.rstrip()
+        while position < len(formula):
+            match = token_regex.match(formula, position)
+            if not match:
+                raise ValueError('Calculation failed, did you try something weird?')
+            self.tokens.append(match)
+            position = match.end()
+        self.position = 0
+
+    def parse(self):
+        root = self.sum()
+        if self.position != len(self.tokens):
+            raise ValueError('Calculation failed, did you try something weird?')
+        return Formula(root, self.pools)
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position].group(5)
+        return None
+
+    def sum(self):
+        node = self.product()
+        while self.peek() in ('+', '-'):
+            self.position += 1
+            node = Operation(self.tokens[self.position - 1].group(5), node, self.product())
+        return node
+
+    def product(self):
+        node = self.unary()
+        while self.peek() in ('*', '/', '%'):
+            self.position += 1
+            node = Operation(self.tokens[self.position - 1].group(5), node, self.unary())
+        return node
+
+    def unary(self):
+        if self.peek() == '-':
+            self.position += 1
+            return Negate(self.unary())
+        if self.peek() == '+':
+            self.position += 1
+            return self.unary()
+        return self.power()
+
+    def power(self):
+        node = self.atom()
+        if self.peek() in ('^', '**'):
+            self.position += 1
+            node = Operation(self.tokens[self.position - 1].group(5), node, self.unary())
+        return node
+
+    def atom(self):
+        if self.position >= len(self.tokens):
+            raise ValueError('Calculation failed, did you try something weird?')
+        token = self.tokens[self.position]
+        self.position += 1
+        if any(len(digits) > MAX_DIGITS for digits in token.groups()[:4] if digits):
+            raise ValueError('Calculation failed, did you try something weird?')
+        if token.group(2) is not None:
+            rolls, size = int(token.group(1) or 1), int(token.group(2))
+            drop = int(token.group(3) or 0)
+            if size < 1:
+                raise ValueError('Dice need at least one face.')
+            if token.group(3) is not None and drop >= rolls:
+                raise ValueError('You\'re trying to drop too many dice.')
+            pool = Pool(rolls, size, drop)
+            self.pools.append(pool)
+            return pool
+        if token.group(4) is not None:
+            return Number(token.group(4))
+        if token.group(5) == '(':
+            node = self.sum()
+            if self.peek() != ')':
+                raise ValueError('Calculation failed, did you try something weird?')
+            self.position += 1
+            return Group(node)
+        raise ValueError('Calculation failed, did you try something weird?')
+
+
+def compileFormula(formula):
+    """Returns the compiled form of a normalized formula, cached by its text."""
+    if formula in formulas:
+        return formulas[formula]
+    compiled = FormulaParser(formula).parse()
+    if len(formulas) >= FORMULA_CACHE_SIZE:
+        formulas.clear()
+    formulas[formula] = compiled
+    return compiled
+
+
+def formatResult(value):
+    """Shows whole results without a decimal point."""
+    if isinstance(value, float):
+        if value.is_integer() and abs(value) < 1e15:
+            return str(int(value))
+        return '%.10g' % value
+    return str(value)
+
+
+class CampaignLogs(object):
+    """
+    Appends rolls to <logdir>/<campaign>.log, keeping a handle open for
+    each campaign instead of opening the log for every roll.
+
+    Lines are buffered in memory and written once buffer_lines are pending,
+    every flush_interval seconds by a background thread, and on close(). A
+    log that has grown past max_bytes is rotated to <campaign>.log.1, the
+    older ones shifting up to <campaign>.log.<backups>.
+
+    Lines that cannot be written are dropped and counted in dropped; the
+    error is passed to log, if given, and logging carries on.
+    """
+    def __init__(self, logdir, campaigns, buffer_lines=50, flush_interval=5,
+                 max_bytes=0, backups=5, log=None):
+        self.logdir = logdir
+        self.log = log
+        self.dropped = 0
+        self.campaigns = set(c.strip().lower() for c in campaigns if c.strip())
+        self.buffer_lines = buffer_lines
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._lock = threading.Lock()
+        self._handles = {}
+        self._pending = {}
+        self._buffered = 0
+        self._stopping = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, args=(flush_interval,))
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def add(self, campaign):
+        with self._lock:
+            self.campaigns.add(campaign)
+
+    def remove(self, campaign):
+        """Stops logging a campaign, writing out its buffered rolls."""
+        with self._lock:
+            self.campaigns.discard(campaign)
+            self._write(campaign)
+            handle = self._handles.pop(campaign, None)
+            if handle is not None:
+                try:
+                    handle.close()
+                except EnvironmentError:
+                    pass
+
+    def write(self, campaign, line):
+        """Buffers a line of campaign's log."""
+        with self._lock:
+            self._pending.setdefault(campaign, []).append(line)
+            self._buffered += 1
+            if self._buffered >= self.buffer_lines:
+                self._write_all()
+
+    def flush(self):
+        """Writes out every buffered line."""
+        with self._lock:
+            self._write_all()
+
+    def _flush_loop(self, interval):
+        while not self._stopping.wait(interval):
+            self.flush()
+
+    def _write_all(self):
+        for campaign in list(self._pending):
+            self._write(campaign)
+        self._buffered = 0
+
+    def _write(self, campaign):
+        lines = self._pending.pop(campaign, None)
+        if not lines:
+            return
+        self._buffered -= len(lines)
+        try:
+            handle = self._handles.get(campaign)
+            if handle is None:
+                handle = open(self._filename(campaign), 'a')
+                self._handles[campaign] = handle
+            handle.write(''.join(lines))
+            handle.flush()
+            if self.max_bytes and handle.tell() >= self.max_bytes:
+                self._rotate(campaign)
+        except EnvironmentError as e:
+            #Reopen the log on the next write rather than reuse a broken handle
+            handle = self._handles.pop(campaign, None)
+            if handle is not None:
+                try:
+                    handle.close()
+                except EnvironmentError:
+                    pass
+            self.dropped += len(lines)
+            if self.log is not None:
+                self.log('Could not write %d rolls to the %s log: %s'
+                         % (len(lines), campaign, e))
+
+    def _filename(self, campaign):
+        return os.path.join(self.logdir, campaign + '.log')
+
+    def _rotate(self, campaign):
+        self._handles.pop(campaign).close()
+        filename = self._filename(campaign)
+        if self.backups < 1:
+            os.remove(filename)
+            return
+        if os.path.exists('%s.%d' % (filename, self.backups)):
+            os.remove('%s.%d' % (filename, self.backups))
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists('%s.%d' % (filename, i)):
+                os.rename('%s.%d' % (filename, i), '%s.%d' % (filename, i + 1))
+        os.rename(filename, filename + '.1')
+
+    def close(self):
+        """Writes out every buffered line and closes the logs."""
+        self._stopping.set()
+        self._flusher.join()
+        with self._lock:
+            self._write_all()
+            for handle in self._handles.values():
+                try:
+                    handle.close()
+                except EnvironmentError:
+                    pass
+            self._handles.clear()
+
+
+log_line_regex = re.compile(r'^At <(.+?)> (\S+) rolled (.*?): (.*) = ([^=]*)$')
+shown_pool_regex = re.compile(r'\(((?:\d+(?:\+\d+)*)?)(?:\[\+[\d+]+\])?\)'
+                              r'|\((\d+x\d+(?:, \d+x\d+)*)(?: \[dropped [^\]]*\])?\)')
+
+
+class RollHistory(object):
+    """
+    An SQLite index of the rolls logged for campaigns, answering statistics
+    queries without reading the text logs.
+
+    Each roll keeps its time, campaign, nick, formula, total and the faces
+    kept in each pool, along with how many d20 it kept and how many of
+    them were natural 20s and 1s. Writes are queued and performed in
+    batches by a background thread, so add() never blocks on the disk; if
+    the queue is full, the roll is left out of the index. Errors of the
+    writer are passed to log, if given, and the writer carries on.
+    """
+    #Seconds close() waits for the writer before giving up on it
+    close_timeout = 10
+
+    def __init__(self, filename, queue_size=1000, log=None):
+        self.log = log
+        self._lock = threading.Lock()
+        self._filename = filename
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        #WAL lets queries read the database while the writer is committing
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS rolls (time REAL, '
+                         'campaign TEXT, nick TEXT, formula TEXT, dice TEXT, '
+                         'total REAL, d20s INTEGER, nat20s INTEGER, nat1s INTEGER)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS rolls_campaign_nick '
+                         'ON rolls (campaign, nick, time)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS rolls_campaign '
+                         'ON rolls (campaign, time)')
+        self._db.commit()
+        self._queue = Queue(queue_size)
+        self._writer = threading.Thread(target=self._write_loop)
+        self._writer.daemon = True
+        self._writer.start()
+
+    @staticmethod
+    def row(when, campaign, nick, formula, rolled, total):
+        """
+        Returns the row stored for a roll, rolled being the (size, kept face
+        counts) of its pools, or None if they are not known.
+        """
+        d20s = nat20s = nat1s = 0
+        dice = None
+        if rolled is not None:
+            for size, kept in rolled:
+                if size == 20:
+                    d20s += sum(kept.values())
+                    nat20s += kept.get(20, 0)
+                    nat1s += kept.get(1, 0)
+            dice = json.dumps([[size, sorted(kept.items())] for size, kept in rolled],
+                              separators=(',', ':'))
+        return (when, campaign, nick.lower(), formula, dice, total, d20s, nat20s, nat1s)
+
+    def add(self, when, campaign, nick, formula, rolled, total):
+        """Queues a roll to be stored."""
+        try:
+            self._queue.put_nowait(self.row(when, campaign, nick, formula, rolled, total))
+        except Full:
+            pass
+
+    def _write_loop(self):
+        """
+        Stores the queued rolls in batches until close() is called.
+        """
+        db = sqlite3.connect(self._filename)
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < 100:
+                    batch.append(self._queue.get_nowait())
+            except Empty:
+                pass
+            received = len(batch)
+            if None in batch:
+                stopping = True
+                batch = [entry for entry in batch if entry is not None]
+            try:
+                db.executemany('INSERT INTO rolls VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', batch)
+                db.commit()
+            except Exception as e:
+                if self.log is not None:
+                    self.log('Could not store %d rolls: %s' % (len(batch), e))
+            finally:
+                for i in range(received):
+                    self._queue.task_done()
+        db.close()
+
+    def stats(self, campaign, nick=None):
+        """
+        Returns a dict of the number of rolls, their average total, the
+        number of d20 kept, the natural 20 and 1 rates among them, and the
+        longest runs of d20 rolls with a natural 20 or 1, for a campaign or
+        one player of it.
+        """
+        where, args = 'campaign = ?', [campaign]
+        if nick:
+            where += ' AND nick = ?'
+            args.append(nick.lower())
+        with self._lock:
+            count, average, d20s, nat20s, nat1s = self._db.execute(
+                'SELECT COUNT(*), AVG(total), SUM(d20s), SUM(nat20s), SUM(nat1s) '
+                'FROM rolls WHERE ' + where, args).fetchone()
+            streaks = self._db.execute('SELECT nat20s > 0, nat1s > 0 FROM rolls WHERE '
+                                       + where + ' AND d20s > 0 ORDER BY time, rowid', args)
+            best20 = best1 = run20 = run1 = 0
+            for nat20, nat1 in streaks:
+                run20 = run20 + 1 if nat20 else 0
+                run1 = run1 + 1 if nat1 else 0
+                best20 = max(best20, run20)
+                best1 = max(best1, run1)
+        return {'count': count, 'average': average, 'd20s': d20s or 0,
+                'nat20_rate': float(nat20s) / d20s if d20s else None,
+                'nat1_rate': float(nat1s) / d20s if d20s else None,
+                'nat20_streak': best20, 'nat1_streak': best1}
 
-    for i in range(1, rolls + 1):
-        #roll 10 dice, pick a random dice to use, add string to result.
-        result.append((randint(1, size), randint(1, size), randint(1, size),
-                       randint(1, size), randint(1, size), randint(1, size),
-                       randint(1, size), randint(1, size), randint(1, size),
-                       randint(1, size))[randint(0, 9)])
-    return sorted(result)  # returns a set of integers.
+    def import_log(self, campaign, filenames):
+        """
+        Replaces the rolls of a campaign with those read from its text logs,
+        given oldest first. Returns the number of rolls imported.
+
+        The rolls queued so far are written first, so that those already in
+        the logs are not stored twice.
+        """
+        self._queue.join()
+        rows = []
+        for filename in filenames:
+            with open(filename) as log:
+                for line in log:
+                    row = parseLogLine(campaign, line.rstrip('\n'))
+                    if row is not None:
+                        rows.append(row)
+        with self._lock:
+            self._db.execute('DELETE FROM rolls WHERE campaign = ?', (campaign,))
+            self._db.executemany('INSERT INTO rolls VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self._db.commit()
+        return len(rows)
+
+    def close(self):
+        """
+        Writes the queued rolls, then closes the database.
+        """
+        try:
+            self._queue.put(None, timeout=self.close_timeout)
+        except Full:
+            pass
+        self._writer.join(self.close_timeout)
+        self._db.close()
+
+
+def parseLogLine(campaign, line):
+    """
+    Returns the history row of a line of a campaign log, or None if it is
+    not a roll. The kept dice are read back from how the pools were shown
+    when there is one shown pool for each pool of the formula.
+    """
+    match = log_line_regex.match(line)
+    if not match:
+        return None
+    ctime, nick, formula, shown, total = match.groups()
+    try:
+        when = time.mktime(time.strptime(ctime))
+        total = float(total)
+        pools = compileFormula(normalizeFormula(formula)).pools
+    except ValueError:
+        return None
+    shownPools = list(shown_pool_regex.finditer(shown))
+    if len(shownPools) != len(pools):
+        return RollHistory.row(when, campaign, nick, formula, None, total)
+    rolled = []
+    for pool, shownPool in zip(pools, shownPools):
+        listed, summary = shownPool.groups()
+        kept = Counter()
+        if summary is not None:
+            for part in summary.split(', '):
+                face, count = part.split('x')
+                kept[int(face)] += int(count)
+        elif listed:
+            kept.update(int(face) for face in listed.split('+'))
+        rolled.append((pool.size, kept))
+    return RollHistory.row(when, campaign, nick, formula, rolled, total)
+
+
+@commands('dicelog')
+@priority('medium')
+def history(bot, trigger):
+    """
+    .dicelog stats <campaign> [nick]  - Gives the number of rolls, average
+    total, natural 20 and 1 rates and longest streaks of a campaign or of
+    one of its players.
+    .dicelog import <campaign>  - (admin) Rebuilds a campaign's history
+    from its log files.
+    """
+    usage = 'usage: dicelog (stats <campaign> [nick]|import <campaign>)'
+    history = bot.memory['dicelog_history']
+    if history is None:
+        return bot.say('The roll history is disabled.')
+    args = (trigger.group(2) or '').lower().split()
+    if len(args) < 2 or args[0] not in ('stats', 'import'):
+        return bot.say(usage)
+    command, campaign = args[0], args[1]
+    if command == 'import':
+        if not trigger.admin:
+            return
+        bot.memory['dicelog_logs'].flush()
+        filename = os.path.join(bot.config.dicelog.logdir, campaign + '.log')
+        backups = int(bot.config.dicelog.log_backups)
+        filenames = ['%s.%d' % (filename, i) for i in range(backups, 0, -1)] + [filename]
+        filenames = [name for name in filenames if os.path.exists(name)]
+        if not filenames:
+            return bot.say("There is no log for campaign \"%s\"." % campaign)
+        count = history.import_log(campaign, filenames)
+        return bot.say("Imported %d rolls for campaign \"%s\"." % (count, campaign))
+
+    nick = args[2] if len(args) > 2 else None
+    stats = history.stats(campaign, nick)
+    who = campaign + (' (' + nick + ')' if nick else '')
+    if not stats['count']:
+        return bot.say('No rolls logged for %s.' % who)
+    response = '%s: %d rolls, average total %.2f' % (who, stats['count'], stats['average'])
+    if stats['d20s']:
+        response += ('; %d d20: %.1f%% natural 20s, %.1f%% natural 1s; longest '
+                     'streaks %d natural 20s, %d natural 1s' % (
+                         stats['d20s'], 100 * stats['nat20_rate'], 100 * stats['nat1_rate'],
+                         stats['nat20_streak'], stats['nat1_streak']))
+    bot.say(response)
 
 
 @commands('campaign', 'campaigns')
@@ -169,9 +954,11 @@ def campaign(bot, trigger):
             return bot.say('usage: campaign (list|add|del) <args>')
     campaign = campaign.lower().strip()
     campaigns = bot.config.dicelog.campaigns.split(', ')
+    logs = bot.memory['dicelog_logs']
     if campaign in campaigns:
         if command == 'del':
             campaigns.remove(campaign)
+            logs.remove(campaign)
             bot.say("Campaign \"%s\" has been removed!" % campaign)
         else:  # command == 'add'
             bot.say("Campaign \"%s\" already exists!" % campaign)
@@ -180,9 +967,347 @@ def campaign(bot, trigger):
             bot.say("Campaign \"%s\" doesn't exist!" % campaign)
         else:  # command == 'add'
             campaigns.append(campaign)
+            logs.add(campaign)
     if not command == 'list':
         bot.config.dicelog.campaigns = ', '.join(campaigns)
     bot.say("The current list is: " + bot.config.dicelog.campaigns)
 
+# Distributions are (lowest outcome, [probability of each outcome]) pairs.
+distributions = {}
+DISTRIBUTION_CACHE_SIZE = 256
+# Formulas with more possible sums than this are not worked out
+MAX_OUTCOMES = 20000
+# Pools dropping dice take far longer to work out, so are capped lower
+MAX_DROP_OUTCOMES = 3000
+# Pools which fewDroppedDistribution works out quickly enough are not capped
+# by MAX_DROP_OUTCOMES, see fewDroppedWork
+MAX_FEW_DROPPED_WORK = 1200000
+# Probabilities smaller than this are left out of distributions
+NEGLIGIBLE = 1e-16
+# Shorter distributions are convolved directly, longer ones as big integers
+DIRECT_CONVOLUTION = 32
+FIXED_POINT_BITS = 64
+
+
+def diceStats(bot, args):
+    """
+    Replies with the mean, percentiles and range of the outcomes of a
+    formula of XdYvZ pools and constants added or subtracted together, and
+    with the probability of rolling at least a target if one is given.
+    """
+    formula, _, target = args.partition('>=')
+    formula = normalizeFormula(formula)
+    try:
+        terms = compileFormula(formula).terms()
+    except ValueError as e:
+        return bot.reply(str(e))
+    if terms is None:
+        return bot.reply('Stats only handle dice pools and numbers added or '
+                         'subtracted together, e.g. 4d6v1+2.')
+    if sum(rolls * size for sign, rolls, size, drop in terms if size > 1) > MAX_OUTCOMES:
+        return bot.reply('That formula has too many outcomes to work out.')
+    for sign, rolls, size, drop in terms:
+        if (drop and size > 1 and rolls * size > MAX_DROP_OUTCOMES
+                and fewDroppedWork(rolls, size, drop) > MAX_FEW_DROPPED_WORK):
+            return bot.reply('That pool is too large to work out with dice '
+                             'dropped; try fewer dice, or fewer dropped.')
+    low, probabilities = formulaDistribution(formula, terms)
+
+    lowest = highest = 0
+    for sign, rolls, size, drop in terms:
+        bounds = (rolls - drop, (rolls - drop) * size)
+        lowest += sign * bounds[sign < 0]
+        highest += sign * bounds[sign > 0]
+    mean = sum((low + i) * p for i, p in enumerate(probabilities))
+    response = '%s: mean %.2f, range %d-%d, percentiles' % (
+        formula, mean, lowest, highest)
+    response += ' ' + ', '.join('%d%%: %d' % (percent, low + percentile(probabilities, percent / 100.0))
+                                for percent in (5, 25, 50, 75, 95))
+    target = target.strip()
+    if target:
+        if not target.lstrip('-').isdigit():
+            return bot.reply('The target must be a whole number.')
+        index = max(0, int(target) - low)
+        response += '; P(>= %s) = %.2f%%' % (target, 100 * sum(probabilities[index:]))
+    bot.reply(response)
+
+
+def normalizeFormula(formula):
+    """Lowercases a formula, strips its spaces and makes "dY" read "1dY"."""
+    formula = formula.lower().replace(' ', '')
+    return re.sub(r'(^|[^0-9])d', r'\g<1>1d', formula)
+
+
+def formulaDistribution(formula, terms):
+    """
+    Returns the distribution of the sum of terms, memoized by formula.
+    """
+    if formula in distributions:
+        return distributions[formula]
+    low, probabilities = 0, [1.0]
+    for sign, rolls, size, drop in terms:
+        if size == 1:
+            # A constant, or dice which can only roll 1
+            termLow, termProbabilities = rolls - drop, [1.0]
+        elif drop and fewDroppedWork(rolls, size, drop) <= MAX_FEW_DROPPED_WORK:
+            termLow, termProbabilities = trim(*fewDroppedDistribution(rolls, size, drop))
+        elif drop:
+            termLow, termProbabilities = trim(*dropLowestDistribution(rolls, size, drop))
+        else:
+            termLow, termProbabilities = sumDistribution(rolls, size)
+        if sign < 0:
+            termLow = -(termLow + len(termProbabilities) - 1)
+            termProbabilities = termProbabilities[::-1]
+        low, probabilities = trim(low + termLow, convolve(probabilities, termProbabilities))
+    if len(distributions) >= DISTRIBUTION_CACHE_SIZE:
+        distributions.clear()
+    distributions[formula] = (low, probabilities)
+    return low, probabilities
+
+
+def sumDistribution(rolls, size):
+    """
+    Returns the distribution of the sum of rolls dice with size faces.
+    It is built by repeated squaring: the distributions of 1, 2, 4, ...
+    dice are convolved together for each bit of rolls, so only about
+    log2(rolls) convolutions are needed, and trimming their negligible
+    tails keeps each of them short.
+    """
+    low, probabilities = 0, [1.0]
+    powerLow, power = 1, [1.0 / size] * size
+    while rolls:
+        if rolls & 1:
+            low, probabilities = trim(low + powerLow, convolve(probabilities, power))
+        rolls >>= 1
+        if rolls:
+            powerLow, power = trim(2 * powerLow, convolve(power, power))
+    return low, probabilities
+
+
+def dropLowestDistribution(rolls, size, drop):
+    """
+    Returns the distribution of the sum of the highest rolls - drop dice out
+    of rolls dice with size faces.
+
+    Faces are considered from the highest down. When n dice are left to
+    place, all below the current face f, the number of them showing f is
+    binomial with probability 1/f; those dice are kept until rolls - drop
+    dice have been kept, and the dice left after that do not matter.
+    """
+    keep = rolls - drop
+    final = [0.0] * (keep * size + 1)
+    # kept dice so far -> (lowest sum, distribution of their sum)
+    states = {0: (0, [1.0])}
+    for face in range(size, 0, -1):
+        newStates = {}
+        p = 1.0 / face
+        for placed, (low, sums) in states.items():
+            first, binomials = binomialDistribution(rolls - placed, p)
+            for count, binomial in enumerate(binomials, first):
+                if binomial < NEGLIGIBLE:
+                    continue
+                shift = low + min(count, keep - placed) * face
+                if placed + count >= keep:
+                    target, offset = final, 0
+                else:
+                    offset, target = newStates.setdefault(placed + count, (shift, []))
+                    if shift < offset:
+                        target[:0] = [0.0] * (offset - shift)
+                        offset = shift
+                        newStates[placed + count] = (offset, target)
+                    if len(target) < shift - offset + len(sums):
+                        target.extend([0.0] * (shift - offset + len(sums) - len(target)))
+                for outcome, probability in enumerate(sums, shift - offset):
+                    target[outcome] += probability * binomial
+        states = dict((placed, trim(low, sums)) for placed, (low, sums) in newStates.items())
+    return keep, final[keep:]
+
+
+def fewDroppedDistribution(rolls, size, drop):
+    """
+    Returns the distribution of the sum of the highest rolls - drop dice out
+    of rolls dice with size faces, for a few dropped dice.
+
+    It is summed over the face m of the lowest kept die. When j < drop + 1
+    dice are below m, the sum is the sum of the other rolls - j dice, all of
+    m or more, less the drop - j dropped ones which show m, provided at least
+    drop - j + 1 of them show m. The sums of dice of m or more are worked out
+    by sumDistribution as dice with size - m + 1 faces, and those with too
+    few showing m are taken away using the sums of dice above m.
+    """
+    keep = rolls - drop
+    # subtracted sums reach past the highest kept sum, and cancel out there
+    final = [0.0] * (rolls * size - keep + 1)
+    sums = {}
+
+    def truncatedSums(faces):
+        # distributions of keep, keep + 1, ..., rolls dice with faces faces
+        if faces not in sums:
+            counts = [sumDistribution(keep, faces)]
+            for extra in range(drop):
+                counts.append(addDie(counts[-1], faces))
+            sums[faces] = counts
+        return sums[faces]
+
+    def add(low, probabilities, weight):
+        for outcome, probability in enumerate(probabilities, low - keep):
+            final[outcome] += probability * weight
+
+    for m in range(size, 0, -1):
+        faces = size - m + 1
+        for below in range(drop + 1 if m > 1 else 1):
+            left = rolls - below
+            # chance of below dice under m and the others m or more
+            weight = exp(lgamma(rolls + 1) - lgamma(below + 1) - lgamma(left + 1)
+                         + (below * log((m - 1.0) / size) if below else 0.0)
+                         + left * log(float(faces) / size))
+            if weight < NEGLIGIBLE:
+                continue
+            low, probabilities = truncatedSums(faces)[left - keep]
+            add(low + left * (m - 1) - (drop - below) * m, probabilities, weight)
+            if faces == 1:
+                continue
+            first, binomials = binomialDistribution(left, 1.0 / faces)
+            for showing, binomial in enumerate(binomials, first):
+                if showing > drop - below:
+                    break
+                low, probabilities = truncatedSums(faces - 1)[left - showing - keep]
+                add(low + (left - drop + below) * m, probabilities, -weight * binomial)
+    return keep, [max(0.0, p) for p in final[:keep * (size - 1) + 1]]
+
+
+def fewDroppedWork(rolls, size, drop):
+    """
+    Returns a rough measure of the time fewDroppedDistribution takes: the
+    outcomes of the pool, times the faces its lowest kept die shows with a
+    chance that is not negligible, times the convolutions it makes per face.
+    """
+    keep = rolls - drop
+    faces = min(size, size - int(size * NEGLIGIBLE ** (1.0 / keep)) + 1)
+    return rolls * size * faces * (keep.bit_length() + drop)
+
+
+def addDie(distribution, faces):
+    """Returns the distribution of a sum with one more die of faces faces."""
+    low, probabilities = distribution
+    result = []
+    window = 0.0
+    for i in range(len(probabilities) + faces - 1):
+        if i < len(probabilities):
+            window += probabilities[i]
+        if i >= faces:
+            window -= probabilities[i - faces]
+        result.append(max(0.0, window) / faces)
+    return trim(low + 1, result)
+
+
+def trim(low, probabilities):
+    """Drops negligible outcomes from both ends of a distribution."""
+    start, end = 0, len(probabilities)
+    while start < end - 1 and probabilities[start] < NEGLIGIBLE:
+        start += 1
+    while end > start + 1 and probabilities[end - 1] < NEGLIGIBLE:
+        end -= 1
+    return low + start, probabilities[start:end]
+
+
+def binomialDistribution(n, p):
+    """
+    Returns the lowest number of successes out of n tries of probability p
+    that is not negligible, and the probabilities from there on. Worked out
+    outwards from the most likely count, with logarithms so that large n do
+    not underflow.
+    """
+    if p >= 1.0:
+        return n, [1.0]
+    mode = int((n + 1) * p)
+    if mode > n:
+        mode = n
+    peak = exp(lgamma(n + 1) - lgamma(mode + 1) - lgamma(n - mode + 1)
+               + mode * log(p) + (n - mode) * log(1.0 - p))
+    odds = p / (1.0 - p)
+    above = [peak]
+    k = mode
+    while k < n and above[-1] >= NEGLIGIBLE:
+        above.append(above[-1] * (n - k) / (k + 1) * odds)
+        k += 1
+    below = []
+    probability, k = peak, mode
+    while k > 0 and probability >= NEGLIGIBLE:
+        probability = probability * k / (n - k + 1) / odds
+        below.append(probability)
+        k -= 1
+    return mode - len(below), below[::-1] + above
+
+
+def convolve(a, b):
+    """
+    Returns the distribution of the sum of two independent outcomes.
+    Long distributions are convolved by Kronecker substitution: their
+    probabilities are packed as fixed-point digits of two big integers,
+    whose product, worked out by Python's Karatsuba multiplication, has
+    the convolution as its digits.
+    """
+    if len(a) < len(b):
+        a, b = b, a
+    if len(b) < DIRECT_CONVOLUTION:
+        result = [0.0] * (len(a) + len(b) - 1)
+        for j, q in enumerate(b):
+            if q:
+                for i, p in enumerate(a):
+                    result[i + j] += p * q
+        return result
+    scale = float(1 << FIXED_POINT_BITS)
+    # wide enough for the sum of len(b) products of two fixed-point numbers
+    digits = (2 * FIXED_POINT_BITS + len(b).bit_length() + 4) // 4
+    digit = '%0' + str(digits) + 'x'
+    packed = [int(''.join(digit % int(p * scale) for p in reversed(probabilities)), 16)
+              for probabilities in (a, b)]
+    outcomes = len(a) + len(b) - 1
+    product = ('%x' % (packed[0] * packed[1])).rjust(outcomes * digits, '0')
+    end = len(product)
+    return [int(product[end - (i + 1) * digits:end - i * digits], 16) / scale / scale
+            for i in range(outcomes)]
+
+
+def percentile(probabilities, fraction):
+    """Returns the index of the outcome at the given cumulative fraction."""
+    cumulative = 0.0
+    for i, p in enumerate(probabilities):
+        cumulative += p
+        if cumulative >= fraction - 1e-12:
+            return i
+    return len(probabilities) - 1
+
+
+def benchmark():
+    """
+    Times rolling a pool, dropping its lowest die and summing it, from 1d20
+    to 1000000d10, against the former one-randint-per-candidate roller.
+    """
+    import timeit
+    from random import randint
+
+    def former(rolls, size):
+        dice = sorted([(randint(1, size), randint(1, size), randint(1, size),
+                        randint(1, size), randint(1, size), randint(1, size),
+                        randint(1, size), randint(1, size), randint(1, size),
+                        randint(1, size))[randint(0, 9)] for i in range(rolls)])
+        return sum(dice[1:])
+
+    print('%-12s %14s %14s' % ('pool', 'batched', 'former'))
+    for formula, number in (('1d20', 10000), ('4d6', 10000), ('100d6', 1000),
+                            ('10000d10', 10), ('1000000d10', 1)):
+        rolls, size = map(int, formula.split('d'))
+        timings = []
+        for roll in (lambda: total(splitLowest(rollCounts(rolls, size), 1)[0]),
+                     lambda: former(rolls, size)):
+            seconds = min(timeit.repeat(roll, number=number, repeat=3))
+            timings.append('%11.1f us' % (seconds / number * 1e6))
+        print('%-12s %14s %14s' % (formula, timings[0], timings[1]))
+
 if __name__ == '__main__':
-    print(__doc__.strip())
+    if '--benchmark' in sys.argv:
+        benchmark()
+    else:
+        print(__doc__.strip())
@@ -8,44 +8,522 @@ Licensed under the Eiffel Forum License 2.
 import json
 import re
 import os.path
+import sqlite3
 import sys
+import threading
+import time
+from collections import OrderedDict
 if sys.version_info.major < 3:
-    from urllib2 import HTTPError
     from urlparse import urlparse
+    from Queue import Queue, Empty, Full
 else:
-    from urllib.request import HTTPError
     from urllib.parse import urlparse
+    from queue import Queue, Empty, Full
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import HTTPError, RequestException
 from sopel.config import ConfigurationError
-from sopel import web, tools
-from sopel.module import rule
+from sopel import tools
+from sopel.module import rule, commands
+
+imgur_regex = re.compile('(?<![\w.-])(?:https?://)?(?:[im]\.)?imgur\.com/[^\s<>()"\']*')
+
+class ResourceCache(object):
+    """
+    A bounded, thread-safe cache of API responses.
+
+    Entries expire ttl seconds after being stored; when the cache is full
+    the least recently used entry is evicted. Hits, misses and evictions
+    are counted so the cache can be sized from its stats().
+    """
+    def __init__(self, ttl=3600, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the cached value for key, or None if it is absent or stale.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.time():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            # Re-insert to mark the entry as most recently used
+            del self._entries[key]
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """
+        Stores value under key, evicting the least recently used entries
+        if the cache is full.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """
+        Returns a dict of the cache's size and hit/miss/eviction counters.
+        """
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+class PersistentCache(object):
+    """
+    An SQLite-backed store of API responses, meant to sit behind a
+    ResourceCache so that metadata survives restarts.
+
+    Entries expire ttl seconds after being stored, and the oldest entries
+    are pruned once there are more than max_entries. Writes are queued and
+    performed by a background thread, so set() never blocks on the disk;
+    if the queue is full, the write is dropped. Errors of the writer are
+    passed to log, if given, and the writer carries on.
+    """
+    #Seconds close() waits for the writer before giving up on it
+    close_timeout = 10
+
+    def __init__(self, filename, ttl=604800, max_entries=100000, queue_size=1000,
+                 log=None):
+        self.ttl = ttl
+        self.log = log
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._filename = filename
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        #WAL lets lookups read the database while the writer is committing
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS resources (resource TEXT, '
+                         'id TEXT, data TEXT, expires REAL, '
+                         'PRIMARY KEY (resource, id))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS resources_expires '
+                         'ON resources (expires)')
+        self._db.commit()
+        self._queue = Queue(queue_size)
+        self._writer = threading.Thread(target=self._write_loop)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def get(self, key):
+        """
+        Returns the stored value for key, or None if it is absent or stale.
+        """
+        resource, id = key
+        with self._lock:
+            row = self._db.execute('SELECT data FROM resources WHERE resource = ? '
+                                   'AND id = ? AND expires > ?',
+                                   (resource, id, time.time())).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        """
+        Queues value to be stored under key.
+        """
+        try:
+            self._queue.put_nowait((key, json.dumps(value), time.time() + self.ttl))
+        except Full:
+            pass
+
+    def _write_loop(self):
+        """
+        Stores the queued entries in batches until close() is called.
+        """
+        db = sqlite3.connect(self._filename)
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < 100:
+                    batch.append(self._queue.get_nowait())
+            except Empty:
+                pass
+            if None in batch:
+                stopping = True
+                batch = [entry for entry in batch if entry is not None]
+            try:
+                db.executemany('INSERT OR REPLACE INTO resources '
+                               '(resource, id, data, expires) VALUES (?, ?, ?, ?)',
+                               [(key[0], key[1], data, expires)
+                                for key, data, expires in batch])
+                self._prune(db)
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                if self.log is not None:
+                    self.log('Could not store %d entries: %s' % (len(batch), e))
+        db.close()
+
+    def _prune(self, db):
+        """
+        Deletes expired entries, then the oldest ones beyond max_entries.
+        """
+        db.execute('DELETE FROM resources WHERE expires <= ?', (time.time(),))
+        excess = db.execute('SELECT COUNT(*) FROM resources').fetchone()[0] \
+                 - self.max_entries
+        if excess > 0:
+            db.execute('DELETE FROM resources WHERE rowid IN (SELECT rowid '
+                       'FROM resources ORDER BY expires LIMIT ?)', (excess,))
+
+    def stats(self):
+        """
+        Returns a dict of the store's size and hit/miss counters.
+        """
+        with self._lock:
+            size = self._db.execute('SELECT COUNT(*) FROM resources').fetchone()[0]
+            return {'size': size, 'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        """
+        Writes the queued entries, then closes the database.
+        """
+        try:
+            self._queue.put(None, timeout=self.close_timeout)
+        except Full:
+            pass
+        self._writer.join(self.close_timeout)
+        self._db.close()
+
+#Request priorities, from the most to the least important
+PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW = 0, 1, 2
+
+class QuotaExceeded(Exception):
+    pass
+
+class RateLimiter(object):
+    """
+    Tracks the API credits left, as reported by the X-RateLimit-* headers
+    of imgur's responses, and decides which requests may still be sent.
+
+    Once fewer than reserve (a fraction of the limit) credits are left, only
+    PRIORITY_NORMAL and PRIORITY_HIGH requests are sent; below half of the
+    reserve, only PRIORITY_HIGH ones; with no credits left, none at all
+    until the credits are reset.
+    """
+    #Forget credit counts which have not been refreshed for this long, so
+    #that a request is eventually let through to find out the new quota.
+    stale_after = 3600
+
+    def __init__(self, reserve=0.1):
+        self.reserve = reserve
+        self.client_limit = self.client_remaining = None
+        self.user_limit = self.user_remaining = None
+        self.user_reset = None
+        self.updated = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def update(self, headers, status_code=None):
+        """
+        Records the credits reported by the headers of a response.
+        """
+        def header(name):
+            try:
+                return int(headers[name])
+            except (KeyError, TypeError, ValueError):
+                return None
+
+        with self._lock:
+            self.updated = time.time()
+            for attribute, name in (('client_limit', 'X-RateLimit-ClientLimit'),
+                                    ('client_remaining', 'X-RateLimit-ClientRemaining'),
+                                    ('user_limit', 'X-RateLimit-UserLimit'),
+                                    ('user_remaining', 'X-RateLimit-UserRemaining'),
+                                    ('user_reset', 'X-RateLimit-UserReset')):
+                value = header(name)
+                if value is not None:
+                    setattr(self, attribute, value)
+            if status_code == 429:
+                self.user_remaining = 0
+                if self.user_reset is None or self.user_reset < time.time():
+                    self.user_reset = time.time() + self.stale_after
+
+    def _fraction(self):
+        """
+        Returns the smallest fraction of credits left, or None if unknown.
+        """
+        now = time.time()
+        if self.user_reset is not None and self.user_reset < now:
+            self.user_remaining = self.user_reset = None
+        if self.updated < now - self.stale_after:
+            self.client_remaining = None
+            if self.user_reset is None:
+                self.user_remaining = None
+        fractions = []
+        for remaining, limit in ((self.client_remaining, self.client_limit),
+                                 (self.user_remaining, self.user_limit)):
+            if remaining is not None:
+                fractions.append(float(remaining) / limit if limit else
+                                 (1.0 if remaining > 0 else 0.0))
+        return min(fractions) if fractions else None
+
+    def acquire(self, priority=PRIORITY_NORMAL):
+        """
+        Raises QuotaExceeded if a request of the given priority should not be
+        sent with the credits left.
+        """
+        with self._lock:
+            fraction = self._fraction()
+            if fraction is None or fraction >= self.reserve:
+                return
+            if fraction > 0:
+                if priority == PRIORITY_HIGH:
+                    return
+                if priority == PRIORITY_NORMAL and fraction >= self.reserve / 2:
+                    return
+            self.dropped += 1
+        raise QuotaExceeded('Not enough imgur API credits left')
+
+    def throttling(self):
+        """
+        Returns True if some requests are currently being dropped.
+        """
+        with self._lock:
+            fraction = self._fraction()
+            return fraction is not None and fraction < self.reserve
+
+    def stats(self):
+        """
+        Returns a dict of the credits left and of the dropped requests.
+        """
+        with self._lock:
+            self._fraction()
+            return {'client_remaining': self.client_remaining,
+                    'client_limit': self.client_limit,
+                    'user_remaining': self.user_remaining,
+                    'user_limit': self.user_limit,
+                    'user_reset': self.user_reset,
+                    'dropped': self.dropped}
+
+class ServiceUnavailable(Exception):
+    pass
+
+class NotFound(Exception):
+    pass
+
+class CircuitBreaker(object):
+    """
+    Stops requests from being sent to an API which keeps failing.
+
+    After threshold consecutive failures the circuit opens, and requests
+    are refused for cooldown seconds. A single trial request is then let
+    through: if it succeeds the circuit closes again, otherwise it stays
+    open for another cooldown.
+    """
+    def __init__(self, threshold=5, cooldown=60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.short_circuited = 0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def before(self):
+        """
+        Raises ServiceUnavailable if no request should be sent right now.
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if self.opened_at + self.cooldown <= time.time() and not self._trial:
+                self._trial = True
+                return
+            self.short_circuited += 1
+        raise ServiceUnavailable('The imgur API is failing, try again later')
+
+    def success(self):
+        """
+        Records a successful request, closing the circuit.
+        """
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self):
+        """
+        Records a failed request, opening the circuit if there were too many.
+        """
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.threshold:
+                self.opened_at = time.time()
+            self._trial = False
+
+    def is_open(self):
+        """
+        Returns True if requests are currently being refused.
+        """
+        with self._lock:
+            return self.opened_at is not None
 
 class ImgurClient(object):
-    def __init__(self, client_id):
+    def __init__(self, client_id, pool_size=10, timeout=10, cache=None,
+                 limiter=None, store=None, breaker=None, missing=None):
         """
         Sets the client_id (obtain yours here: https://api.imgur.com/oauth2/addclient)
         and the imgur API URL.
+
+        A single keep-alive session is shared by every request made through
+        this client, so connections to the API are pooled (up to pool_size)
+        instead of being re-established for each link.
+
+        If a ResourceCache is given, resource() is served from it when possible,
+        falling back to the PersistentCache store, if any, before the API.
+        The RateLimiter keeps track of the API credits left, and the
+        CircuitBreaker of the API's health. Resources which do not exist are
+        remembered in the missing ResourceCache, so they are not requested
+        again and again.
         """
         self.client_id = client_id
+        self.cache = cache
+        self.store = store
+        self.limiter = limiter or RateLimiter()
+        self.breaker = breaker or CircuitBreaker()
+        self.valid = None
+        #held while the client ID is being checked, so that only one check is in flight
+        self.validation_lock = threading.Lock()
+        self.missing = missing or ResourceCache(ttl=300)
         self.api_url = "https://api.imgur.com/3/"
-
-    def request(self, input):
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update({'Authorization': 'Client-ID ' + self.client_id,
+                                     'Accept': 'application/json'})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+
+    def request(self, input, priority=PRIORITY_NORMAL):
         """
         Sends a request to the API. Only publicly available data is accessible.
+        Raises QuotaExceeded if the request was dropped to spare the credits
+        left, ServiceUnavailable if it was not sent because the API keeps
+        failing, and requests' HTTPError if the API returned an error status.
         Returns data as JSON.
         """
-        headers = {'Authorization': 'Client-ID ' + self.client_id,
-                   'Accept': 'application/json'}
-        request = web.get(self.api_url + input, headers=headers)
-        #FIXME: raise for status
-        return json.loads(request)
+        self.limiter.acquire(priority)
+        self.breaker.before()
+        try:
+            response = self.session.get(self.api_url + input, timeout=self.timeout)
+        except RequestException:
+            self.breaker.failure()
+            raise
+        self.limiter.update(response.headers, response.status_code)
+        if response.status_code >= 500:
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+        response.raise_for_status()
+        return response.json()
+
+    def check_credentials(self):
+        """
+        Checks the client ID against the API's credits endpoint, whose reply
+        is tiny and primes the RateLimiter.
+        Returns True if the client ID was accepted, False if it was rejected,
+        or None if the API could not tell. The answer is kept in self.valid.
+        """
+        try:
+            self.request('credits', PRIORITY_HIGH)
+        except HTTPError as e:
+            if e.response is not None and e.response.status_code in (401, 403):
+                self.valid = False
+                return False
+            return None
+        except (RequestException, QuotaExceeded, ServiceUnavailable, ValueError):
+            return None
+        self.valid = True
+        return True
+
+    def close(self):
+        """
+        Closes the pooled connections held by the client, and its store.
+        """
+        self.session.close()
+        if self.store is not None:
+            self.store.close()
 
-    def resource(self, resource, id):
+    def resource(self, resource, id, priority=PRIORITY_NORMAL):
         """
-        Retrieves a resource from the imgur API.
+        Retrieves a resource from the imgur API, or from the cache if it
+        has been retrieved recently.
+        Raises NotFound if the resource does not exist.
         Returns data as JSON.
         """
+        key = (resource, id)
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+        if self.missing.get(key) is not None:
+            raise NotFound('{0}/{1}'.format(resource, id))
+        if self.store is not None:
+            stored = self.store.get(key)
+            if stored is not None:
+                if self.cache is not None:
+                    self.cache.set(key, stored)
+                return stored
         api_request_path = '{0}/{1}'.format(resource, id)
-        return self.request(api_request_path)
+        try:
+            data = self.request(api_request_path, priority)
+        except HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                self.missing.set(key, True)
+                raise NotFound(api_request_path)
+            raise
+        if self.cache is not None:
+            self.cache.set(key, data)
+        if self.store is not None:
+            self.store.set(key, data)
+        return data
+
+def fetch_all(calls):
+    """
+    Runs each (function, args) pair of calls in its own thread and waits for
+    all of them to finish.
+    Returns the results in the order of calls. If any call raised, the first
+    exception (in the order of calls) is re-raised once every thread has
+    been joined.
+    """
+    results = [None] * len(calls)
+    errors = [None] * len(calls)
+
+    def run(index, function, args):
+        try:
+            results[index] = function(*args)
+        except Exception as e:
+            errors[index] = e
+
+    threads = [threading.Thread(target=run, args=(i, function, args))
+               for i, (function, args) in enumerate(calls)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for error in errors:
+        if error is not None:
+            raise error
+    return results
 
 def configure(config):
     """
@@ -55,116 +533,228 @@ def configure(config):
     |  [imgur]  |     example     |              purpose             |
     | --------- | --------------- | -------------------------------- |
     | client_id | 1b3cfe15768ba29 | Bot's ID, for Imgur's reference. |
+    | pool_size | 10              | Max. kept-alive API connections  |
+    | timeout   | 10              | Per-request timeout, in seconds  |
+    | max_links | 10              | Max. lookups for a single line   |
+    | cache_ttl | 3600            | Seconds to cache API responses   |
+    | cache_size| 1000            | Max. number of cached responses  |
+    | quota_reserve | 0.1         | Share of API credits held back   |
+    | breaker_threshold | 5       | Failures before pausing requests |
+    | breaker_cooldown | 60       | Seconds to pause requests for    |
+    | not_found_ttl | 300         | Seconds to remember missing ids  |
+    | validate  | background      | When to check the client ID      |
+    | cache_db  | imgur.db        | SQLite file to keep responses in |
+    | cache_db_ttl | 604800       | Seconds to keep them on disk     |
+    | cache_db_size | 100000      | Max. number of responses on disk |
+
+    The on-disk cache is disabled unless cache_db is set. A relative path
+    is relative to the bot's home directory.
+
+    The client ID is checked in the background once the module is loaded
+    (background), when the first link is looked up (lazy), or before the
+    module finishes loading (startup). If it is rejected, links are ignored.
     """
 
     if config.option('Configure Imgur? (You will need to register at https://api.imgur.com/oauth2/addclient)', False):
         config.interactive_add('imgur', 'client_id', 'Client ID')
 
-def setup(bot):
+def check_credentials(bot, client):
     """
-    Tests the validity of the client ID given in the configuration.
-    If it is not, initializes sopel's memory callbacks for imgur URLs,
-    and uses them as the trigger for the link parsing function.
+    Tests the validity of the client ID given in the configuration, and
+    logs the outcome if it is not valid or could not be tested. If a test
+    is already in flight, returns what is known so far without waiting.
     """
+    if not client.validation_lock.acquire(False):
+        return client.valid
     try:
-        client = ImgurClient(bot.config.imgur.client_id)
-        client.request('gallery.json')
-    except HTTPError:
-        raise ConfigurationError('Could not validate the client ID with Imgur. \
-                                 Are you sure you set it up correctly?')
-    imgur_regex = re.compile('(?:https?://)?(?:i\.)?imgur\.com/(.*)$')
+        valid = client.check_credentials()
+    finally:
+        client.validation_lock.release()
+    if valid is False:
+        bot.debug('imgur', 'The client ID was rejected by Imgur, imgur links '
+                  'will be ignored. Are you sure you set it up correctly?',
+                  'warning')
+    elif valid is None:
+        bot.debug('imgur', 'Could not validate the client ID with Imgur, '
+                  'will try again on the next link.', 'warning')
+    return valid
+
+def setup(bot):
+    """
+    Initializes sopel's memory callbacks for imgur URLs, and uses them as
+    the trigger for the link parsing function.
+
+    The client is kept in the bot's memory and shared by every lookup.
+    Its client ID is tested according to the validate option, so that
+    loading the module need not wait for the API.
+    """
+    if not bot.config.has_option('imgur', 'pool_size'):
+        bot.config.parser.set('imgur', 'pool_size', '10')
+    if not bot.config.has_option('imgur', 'timeout'):
+        bot.config.parser.set('imgur', 'timeout', '10')
+    if not bot.config.has_option('imgur', 'max_links'):
+        bot.config.parser.set('imgur', 'max_links', '10')
+    if not bot.config.has_option('imgur', 'cache_ttl'):
+        bot.config.parser.set('imgur', 'cache_ttl', '3600')
+    if not bot.config.has_option('imgur', 'cache_size'):
+        bot.config.parser.set('imgur', 'cache_size', '1000')
+    if not bot.config.has_option('imgur', 'quota_reserve'):
+        bot.config.parser.set('imgur', 'quota_reserve', '0.1')
+    if not bot.config.has_option('imgur', 'breaker_threshold'):
+        bot.config.parser.set('imgur', 'breaker_threshold', '5')
+    if not bot.config.has_option('imgur', 'breaker_cooldown'):
+        bot.config.parser.set('imgur', 'breaker_cooldown', '60')
+    if not bot.config.has_option('imgur', 'not_found_ttl'):
+        bot.config.parser.set('imgur', 'not_found_ttl', '300')
+    if not bot.config.has_option('imgur', 'validate'):
+        bot.config.parser.set('imgur', 'validate', 'background')
+    if not bot.config.has_option('imgur', 'cache_db_ttl'):
+        bot.config.parser.set('imgur', 'cache_db_ttl', '604800')
+    if not bot.config.has_option('imgur', 'cache_db_size'):
+        bot.config.parser.set('imgur', 'cache_db_size', '100000')
+    cache = ResourceCache(ttl=float(bot.config.imgur.cache_ttl),
+                          max_entries=int(bot.config.imgur.cache_size))
+    store = None
+    if bot.config.imgur.cache_db:
+        filename = os.path.join(bot.config.homedir,
+                                os.path.expanduser(bot.config.imgur.cache_db))
+        store = PersistentCache(filename, ttl=float(bot.config.imgur.cache_db_ttl),
+                                max_entries=int(bot.config.imgur.cache_db_size),
+                                log=lambda message: bot.debug('imgur', message, 'warning'))
+    client = ImgurClient(bot.config.imgur.client_id,
+                         pool_size=int(bot.config.imgur.pool_size),
+                         timeout=float(bot.config.imgur.timeout),
+                         cache=cache,
+                         limiter=RateLimiter(float(bot.config.imgur.quota_reserve)),
+                         store=store,
+                         breaker=CircuitBreaker(int(bot.config.imgur.breaker_threshold),
+                                                float(bot.config.imgur.breaker_cooldown)),
+                         missing=ResourceCache(ttl=float(bot.config.imgur.not_found_ttl),
+                                               max_entries=int(bot.config.imgur.cache_size)))
+    if bot.config.imgur.validate == 'startup':
+        if not client.check_credentials():
+            client.close()
+            raise ConfigurationError('Could not validate the client ID with Imgur. \
+                                     Are you sure you set it up correctly?')
+    elif bot.config.imgur.validate == 'background':
+        validation = threading.Thread(target=check_credentials, args=(bot, client))
+        validation.daemon = True
+        validation.start()
+    bot.memory['imgur_client'] = client
     if not bot.memory.contains('url_callbacks'):
         bot.memory['url_callbacks'] = tools.SopelMemory()
     bot.memory['url_callbacks'][imgur_regex] = imgur
 
-def album(link_id, bot):
+def shutdown(bot):
+    """
+    Releases the pooled connections of the shared client.
+    """
+    client = bot.memory.get('imgur_client')
+    if client is not None:
+        client.close()
+
+@commands('imgurstats')
+def imgurstats(bot, trigger):
+    """
+    Reports the usage statistics of the imgur metadata caches, and the API
+    credits left.
+    """
+    client = bot.memory['imgur_client']
+    stats = client.cache.stats()
+    bot.say('[imgur] cache: {0} entries, {1} hits, {2} misses, ' \
+            '{3} evictions'.format(stats['size'], stats['hits'],
+                                   stats['misses'], stats['evictions']))
+    if client.store is not None:
+        stats = client.store.stats()
+        bot.say('[imgur] disk cache: {0} entries, {1} hits, ' \
+                '{2} misses'.format(stats['size'], stats['hits'], stats['misses']))
+    quota = dict((key, '?' if value is None else value)
+                 for key, value in client.limiter.stats().items())
+    if quota['user_reset'] != '?':
+        quota['user_reset'] = time.strftime('%H:%M:%S',
+                                            time.localtime(quota['user_reset']))
+    bot.say('[imgur] credits: client {client_remaining}/{client_limit}, ' \
+            'user {user_remaining}/{user_limit} (reset at {user_reset}), ' \
+            '{dropped} requests dropped'.format(**quota))
+    bot.say('[imgur] API: {0}, {1} requests short-circuited, {2} missing ' \
+            'resources remembered'.format('paused' if client.breaker.is_open() else 'up',
+                                          client.breaker.short_circuited,
+                                          client.missing.stats()['size']))
+
+def album(link_id, bot, priority=PRIORITY_NORMAL):
     """
     Handles information retrieval for non-gallery albums.
-    The bot will output the title, the number of images and the number of views
+    Returns the title, the number of images and the number of views
     of the album.
     """
-    client = ImgurClient(bot.config.imgur.client_id)
-    api_response = client.resource('album', link_id)
+    client = bot.memory['imgur_client']
+    api_response = client.resource('album', link_id, priority)
     album = api_response['data']
-    return bot.say('[imgur] [{0} - an album with {1} images and ' \
-                   '{2} views]'.format(album['title'].encode('utf-8'),
-                                       str(album['images_count']), \
-                                       str(album['views'])))
+    return u'[{0} - an album with {1} images and ' \
+           u'{2} views]'.format(album['title'] or u'untitled',
+                                album['images_count'], album['views'])
 
-def gallery(link_id, bot):
+def gallery(link_id, bot, priority=PRIORITY_NORMAL):
     """
     Handles information retrieval for gallery images and albums.
-    The bot will output the title, the type (image/album/gif), the number of
+    Returns the title, the type (image/album/gif), the number of
     views, the number of upvotes/downvotes of the gallery resource.
     """
-    client = ImgurClient(bot.config.imgur.client_id)
-    api_response = client.resource('gallery', link_id)
+    client = bot.memory['imgur_client']
+    api_response = client.resource('gallery', link_id, priority)
     gallery = api_response['data']
     if gallery['is_album']:
-        return bot.say('[imgur] [{0} - a gallery album with {1} views ' \
-                       '({2} ups and {3} downs)]'.format(gallery['title'].encode('utf-8'), \
-                                                         str(gallery['views']), \
-                                                         str(gallery['ups']), \
-                                                         str(gallery['downs'])))
-    if gallery['animated'] == True:
-        return bot.say('[imgur] [{0} - a gallery gif with {1} views ' \
-                       '({2} ups and {3} downs)]'.format(gallery['title'].encode('utf-8'), \
-                                                         str(gallery['views']), \
-                                                         str(gallery['ups']), \
-                                                         str(gallery['downs'])))
+        kind = u'gallery album'
+    elif gallery['animated'] == True:
+        kind = u'gallery gif'
     else:
-        return bot.say('[imgur] [{0} - a gallery image with {1} views ' \
-                       '({2} ups and {3} downs)]'.format(gallery['title'].encode('utf-8'), \
-                                                         str(gallery['views']),
-                                                         str(gallery['ups']),
-                                                         str(gallery['downs'])))
+        kind = u'gallery image'
+    return u'[{0} - a {1} with {2} views ' \
+           u'({3} ups and {4} downs)]'.format(gallery['title'] or u'untitled',
+                                              kind, gallery['views'],
+                                              gallery['ups'], gallery['downs'])
 
-def user(username, bot):
+def user(username, bot, priority=PRIORITY_NORMAL):
     """
     Handles information retrieval for user accounts.
-    The bot will output the name, and the numbers of submissions, comments and
+    Returns the name, and the numbers of submissions, comments and
     liked resources, of the selected user.
     """
-    client = ImgurClient(bot.config.imgur.client_id)
-    api_response_account = client.resource('account', username)
-    api_response_gallery_profile = client.resource('account', username + '/gallery_profile')
+    client = bot.memory['imgur_client']
+    api_response_account, api_response_gallery_profile = fetch_all([
+        (client.resource, ('account', username, priority)),
+        (client.resource, ('account', username + '/gallery_profile', priority))])
     account = api_response_account['data']
     gallery_profile = api_response_gallery_profile['data']
-    return bot.say('[imgur] [{0} is an imgurian with {1} points of reputation, ' \
-                   '{2} gallery submissions, {3} comments ' \
-                   'and {4} likes]'.format(account['url'], \
-                                           str(account['reputation']), \
-                                           str(gallery_profile['total_gallery_submissions']), \
-                                           str(gallery_profile['total_gallery_comments']), \
-                                           str(gallery_profile['total_gallery_likes'])))
-
-def image(link_id, bot):
+    return u'[{0} is an imgurian with {1} points of reputation, ' \
+           u'{2} gallery submissions, {3} comments ' \
+           u'and {4} likes]'.format(account['url'],
+                                    account['reputation'],
+                                    gallery_profile['total_gallery_submissions'],
+                                    gallery_profile['total_gallery_comments'],
+                                    gallery_profile['total_gallery_likes'])
+
+def image(link_id, bot, priority=PRIORITY_NORMAL):
     """
     Handles information retrieval for non-gallery images.
-    The bot will output the title, the type (image/gif) and the number of views
+    Returns the title, the type (image/gif) and the number of views
     of the selected image.
     """
-    client = ImgurClient(bot.config.imgur.client_id)
-    api_response = client.resource('image', link_id)
+    client = bot.memory['imgur_client']
+    api_response = client.resource('image', link_id, priority)
     img = api_response['data']
-    if img['title']:
-        title = img['title']
-    if not img['title'] and img['description']:
-        title = img['description']
-    if not img['title'] and not img['description']:
-        title = 'untitled'
+    title = img['title'] or img['description'] or u'untitled'
     if img['animated']:
-        return bot.say('[imgur] [{0} - a gif with {1} views]'.format(title.encode('utf-8'), \
-                                                                     str(img['views'])))
+        return u'[{0} - a gif with {1} views]'.format(title, img['views'])
     else:
-        return bot.say('[imgur] [{0} - an image with {1} views]'.format(title.encode('utf-8'), \
-                                                                        str(img['views'])))
+        return u'[{0} - an image with {1} views]'.format(title, img['views'])
 
-@rule('(?:https?://)?(?:i\.)?imgur\.com/(.*)$')
-def imgur(bot, trigger):
+#The handlers for each kind of resource, as returned by parse_link
+handlers = {'image': image, 'gallery': gallery, 'user': user, 'album': album}
+
+def parse_link(link):
     """
-    Parses the input URL and calls the appropriate function for the resource
-    (an image or an album).
+    Parses an imgur URL into a list of (kind, id) lookups.
 
     imgur has two types of resources: non-gallery and gallery resources.
     Non-gallery resources are images and albums that have not been uploaded
@@ -174,6 +764,8 @@ def imgur(bot, trigger):
     * imgur.com/id can refer to two distinct resources (i.e. a non-gallery image
     and a gallery resource, e.g. imgur.com/VlmfH and imgur.com/gallery/VlmfH)
 
+    * imgur.com/id1,id2,id3 refers to several non-gallery images at once.
+
     * i.imgur.com/id refers by default to the same non-gallery resource as
       imgur.com/id, if there are two distinct resources for this ID.
       It refers to the gallery resource if only the gallery resource exists.
@@ -185,60 +777,139 @@ def imgur(bot, trigger):
 
     * imgur.com/user/username refers solely to an imgur user account.
 
-    The regex rule above will capture either an ID to a gallery or non-gallery
-    image or album, or a path to a certain imgur resource (e.g. gallery/id,
-    user/username, and so forth).
-
     It is more fool-proof to only demand gallery data from the imgur API
     if we get a link that is of the form imgur.com/gallery/id, because
     imgur IDs are not unique (see above) and we can trigger an error if
     we request inexistent gallery data.
+
+    Links to actions that need user authentication are returned as a single
+    ('unauthorized', None) lookup, and malformed links as ('invalid', None).
     """
 
     #urlparse does not support URLs without a scheme.
     #Add 'https' scheme to an URL if it has no scheme.
-    if not urlparse(trigger).scheme:
-        trigger = "https://" + trigger
+    if not urlparse(link).scheme:
+        link = "https://" + link
+    url = urlparse(link)
 
     """Handle i.imgur.com links first.
     They can link to non-gallery images, so we do not request gallery data,
     but simply image data."""
-    if urlparse(trigger).netloc == 'i.imgur.com':
-        image_id = os.path.splitext(os.path.basename(urlparse(trigger).path))[0] # get the ID from the img
-        return image(image_id, bot)
+    if url.netloc == 'i.imgur.com':
+        image_id = os.path.splitext(os.path.basename(url.path))[0] # get the ID from the img
+        return [('image', image_id)] if image_id else []
 
     """Handle imgur.com/* links."""
     #Get the path to the requested resource, from the URL (id, gallery/id, user/username, a/id)
-    resource_path = urlparse(trigger).path.lstrip('/')
+    resource_path = url.path.lstrip('/')
 
     #The following API endpoints require user authentication, which we do not support.
     unauthorized = ['settings', 'notifications', 'message', 'stats']
     if any(item in resource_path for item in unauthorized):
-        return bot.reply("[imgur] Unauthorized action.")
+        return [('unauthorized', None)]
 
     #Separate the URL path into an ordered list of the form ['gallery', 'id']
-    resource_path_parts = filter(None, resource_path.split('/'))
+    resource_path_parts = [part for part in resource_path.split('/') if part]
 
     #Handle a simple link to imgur.com: no ID is given, meaning that the length of the above list is null
     if len(resource_path_parts) == 0:
-        return
+        return []
 
     #Handle a link with a path that has more than two components
     if len(resource_path_parts) > 2:
-        return bot.reply("[imgur] Invalid link.")
+        return [('invalid', None)]
 
-    #Handle a link to an ID: imgur.com/id
+    #Handle a link to one or more IDs: imgur.com/id or imgur.com/id1,id2
     if len(resource_path_parts) == 1:
-        return image(resource_path_parts[0], bot)
+        image_ids = [os.path.splitext(image_id)[0]
+                     for image_id in resource_path_parts[0].split(',')]
+        return [('image', image_id) for image_id in image_ids if image_id]
 
     #Handle a link to a gallery image/album: imgur.com/gallery/id
     if resource_path_parts[0] == 'gallery':
-        return gallery(resource_path_parts[1], bot)
+        return [('gallery', resource_path_parts[1])]
 
     #Handle a link to an user account/profile: imgur.com/user/username
     if resource_path_parts[0] == 'user':
-        return user(resource_path_parts[1], bot)
+        return [('user', resource_path_parts[1])]
 
     #Handle a link to an album: imgur.com/a/id
     if resource_path_parts[0] == 'a':
-        return album(resource_path_parts[1], bot)
+        return [('album', resource_path_parts[1])]
+
+    return [('invalid', None)]
+
+def describe(kind, id, bot, priority=PRIORITY_NORMAL):
+    """
+    Returns the description of a single (kind, id) lookup, or None if the
+    resource could not be retrieved.
+    """
+    if kind == 'unauthorized':
+        return u'[Unauthorized action.]'
+    if kind == 'invalid':
+        return u'[Invalid link.]'
+    try:
+        return handlers[kind](id, bot, priority)
+    except (QuotaExceeded, ServiceUnavailable, NotFound, RequestException,
+            ValueError, KeyError, TypeError):
+        return None
+
+def pack_lines(descriptions, max_length=400):
+    """
+    Joins descriptions into as few '[imgur] ...' lines as possible, none of
+    them longer than max_length characters (unless a single description is).
+    """
+    lines = []
+    line = u'[imgur]'
+    for description in descriptions:
+        if line != u'[imgur]' and len(line) + 1 + len(description) > max_length:
+            lines.append(line)
+            line = u'[imgur]'
+        line += u' ' + description
+    if line != u'[imgur]':
+        lines.append(line)
+    return lines
+
+@rule('.*(?:i\.)?imgur\.com/.*')
+def imgur(bot, trigger):
+    """
+    Finds every imgur link in the message, resolves them concurrently and
+    says their descriptions, packed into as few lines as possible.
+
+    Links are de-duplicated, and so are the lookups they resolve to, so
+    that e.g. imgur.com/id and i.imgur.com/id.png are only fetched once.
+    The API has no multi-id endpoint for images, so imgur.com/id1,id2 links
+    are resolved as one concurrent lookup per ID.
+
+    Only the first lookup has normal priority; the others are the first to
+    be dropped when the API credits run low. Nothing is said about failed
+    lookups while credits are being spared or the API is down, to avoid
+    adding to the flood.
+    """
+    lookups = []
+    for link in imgur_regex.findall(trigger):
+        #Sentence punctuation right after a link is not part of it
+        for lookup in parse_link(link.rstrip('.,;:!?')):
+            if lookup not in lookups:
+                lookups.append(lookup)
+    lookups = lookups[:int(bot.config.imgur.max_links)]
+    if not lookups:
+        return
+
+    client = bot.memory['imgur_client']
+    #Not while the API is down or credits are spared, to avoid adding to the load
+    if client.valid is None and bot.config.imgur.validate != 'startup' and \
+            not client.breaker.is_open() and not client.limiter.throttling():
+        check_credentials(bot, client)
+    if client.valid is False:
+        return
+    descriptions = fetch_all([(describe, (kind, id, bot,
+                                          PRIORITY_LOW if i else PRIORITY_NORMAL))
+                              for i, (kind, id) in enumerate(lookups)])
+    descriptions = [d for d in descriptions if d is not None]
+    if not descriptions:
+        if client.limiter.throttling() or client.breaker.is_open():
+            return
+        return bot.reply('[imgur] Could not retrieve the linked resource.')
+    for line in pack_lines(descriptions):
+        bot.say(line)
@@ -8,14 +8,21 @@ http://sopel.chat
 """
 from __future__ import print_function
 import tweepy
+import threading
 import time
 import re
+from collections import OrderedDict
+from heapq import heappush, heappop
+from itertools import count
 from sopel.config import ConfigurationError
 from sopel import tools
 from sopel.module import rule
 import sys
 if sys.version_info.major < 3:
     str = unicode
+    from Queue import Queue, Empty
+else:
+    from queue import Queue, Empty
 
 try:
     import html
@@ -24,6 +31,12 @@ except ImportError:
     html = HTMLParser.HTMLParser()
 unescape = html.unescape
 
+status_regex = re.compile('twitter.com\/(\S*)\/status\/([\d]+)')
+#statuses/lookup accepts at most this many IDs per request
+LOOKUP_BATCH_SIZE = 100
+#Tweet text is cut to this many characters, so that the line fits on IRC
+MAX_TEXT_LENGTH = 350
+
 
 def configure(config):
     """
@@ -36,6 +49,15 @@ def configure(config):
     | consumer_secret | LIaso6873jI8Yasdlfi76awer76yhasdfi75h6TFJgf | OAuth consumer secret |
     | access_token | 564018348-Alldf7s6598d76tgsadfo9asdf56uUf65aVgdsf6 | OAuth access token |
     | access_token_secret | asdfl7698596KIKJVGvJDcfcvcsfdy85hfddlku67 | OAuth access token secret |
+    | status_cache_size | 1000 | Max. number of tweets to remember |
+    | status_cache_ttl | 3600 | Seconds to remember a tweet for |
+    | timeline_users | 100 | Max. number of user timelines to remember |
+    | timeline_size | 200 | Max. number of tweets to remember per user |
+    | timeline_ttl | 60 | Seconds before checking a timeline for new tweets |
+    | profile_cache_size | 1000 | Max. number of user profiles to remember |
+    | profile_cache_ttl | 3600 | Seconds to remember a user profile for |
+    | queue_size | 50 | Max. number of rate-limited lookups to run later |
+    | relay | aplusk #chan1 #chan2, nasa #chan3 | Accounts whose tweets to relay, and where |
     """
 
     if config.option('Configure Twitter? (You will need to register on http://api.twitter.com)', False):
@@ -45,18 +67,445 @@ def configure(config):
         config.interactive_add('twitter', 'access_token_secret', 'Access token secret')
 
 
+class TTLCache(object):
+    """
+    A thread-safe LRU cache whose entries expire ttl seconds after being
+    stored. Holds at most max_entries entries.
+    """
+    def __init__(self, max_entries=1000, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the value stored for key, or None if absent or expired"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """Stores value for key, evicting the least recently used entries"""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class RateLimited(Exception):
+    """Raised instead of calling an endpoint whose rate limit is used up"""
+    def __init__(self, endpoint, reset):
+        Exception.__init__(self, 'Rate limit reached for ' + endpoint)
+        self.endpoint = endpoint
+        self.reset = reset
+
+
+class RateLimits(object):
+    """
+    Tracks the requests left in the current 15-minute window of each API
+    endpoint, as reported by the x-rate-limit-* response headers.
+
+    tweepy 3 only exposes a call's response as api.last_response, so each
+    thread makes its calls through its own API object, sharing the
+    authentication of api.
+    """
+    #Assumed length of a window if Twitter does not tell when it resets
+    window = 15 * 60
+
+    def __init__(self, api):
+        self.auth = api.auth
+        self._limits = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def api(self):
+        """The API object of the calling thread"""
+        api = getattr(self._local, 'api', None)
+        if api is None:
+            api = self._local.api = tweepy.API(self.auth)
+        return api
+
+    def update(self, endpoint, response):
+        """Records the limits reported by response for endpoint"""
+        if response is None:
+            return
+        try:
+            remaining = int(response.headers['x-rate-limit-remaining'])
+            reset = int(response.headers['x-rate-limit-reset'])
+        except (KeyError, TypeError, ValueError):
+            if response.status_code != 429:
+                return
+            remaining, reset = 0, time.time() + self.window
+        with self._lock:
+            self._limits[endpoint] = (remaining, reset)
+
+    def wait_time(self, endpoint):
+        """
+        Returns how many seconds are left before endpoint can be called, 0
+        if it can be called right away.
+        """
+        with self._lock:
+            remaining, reset = self._limits.get(endpoint, (None, 0))
+        if remaining is None or remaining > 0:
+            return 0
+        return max(0, reset - time.time())
+
+    def call(self, endpoint, method, *args, **kwargs):
+        """
+        Calls the API method named method, which requests endpoint, and
+        records the limits reported by its response. Raises RateLimited
+        instead of calling it if the limit of endpoint has been reached.
+        """
+        if self.wait_time(endpoint):
+            raise RateLimited(endpoint, time.time() + self.wait_time(endpoint))
+        api = self.api
+        try:
+            result = getattr(api, method)(*args, **kwargs)
+            self.update(endpoint, getattr(api, 'last_response', None))
+        except tweepy.TweepError as e:
+            response = getattr(e, 'response', None)
+            self.update(endpoint, response)
+            if response is not None and response.status_code == 429:
+                raise RateLimited(endpoint, time.time() + self.wait_time(endpoint))
+            raise
+        return result
+
+
+class FetchQueue(object):
+    """
+    A bounded queue of lookups which were rate limited, run by a background
+    worker once their endpoint's window has reset, soonest first.
+
+    A lookup which is rate limited again is queued until the new reset. If
+    it fails in any other way, its failed function is called, so that the
+    user who was told to wait still gets an answer.
+    """
+    def __init__(self, limits, max_size=50):
+        self.limits = limits
+        self.max_size = max_size
+        self._size = 0
+        self._lock = threading.Lock()
+        self._queue = Queue()
+        self._worker = threading.Thread(target=self._work)
+        self._worker.daemon = True
+        self._worker.start()
+
+    def submit(self, endpoint, function, failed=None):
+        """
+        Queues function, which requests endpoint, to be called once it is
+        no longer rate limited. Returns False if the queue is full.
+        """
+        with self._lock:
+            if self._size >= self.max_size:
+                return False
+            self._size += 1
+        self._queue.put((endpoint, function, failed))
+        return True
+
+    def _work(self):
+        #(time when ready, order of arrival, endpoint, function, failed)
+        waiting = []
+        order = count()
+        while True:
+            timeout = None
+            if waiting:
+                timeout = max(0, waiting[0][0] - time.time())
+            try:
+                endpoint, function, failed = self._queue.get(timeout=timeout)
+                heappush(waiting, (time.time() + self.limits.wait_time(endpoint),
+                                   next(order), endpoint, function, failed))
+                continue
+            except Empty:
+                pass
+            ready, _, endpoint, function, failed = heappop(waiting)
+            wait = self.limits.wait_time(endpoint)
+            if wait:
+                heappush(waiting, (time.time() + wait, next(order), endpoint, function, failed))
+                continue
+            try:
+                function()
+            except RateLimited as e:
+                heappush(waiting, (e.reset, next(order), e.endpoint, function, failed))
+                continue
+            except Exception:
+                if failed is not None:
+                    try:
+                        failed()
+                    except Exception:
+                        pass
+            with self._lock:
+                self._size -= 1
+
+
+class TimelineCache(object):
+    """
+    Keeps the latest statuses of recently requested user timelines.
+
+    A timeline is refreshed with a since_id request for the statuses posted
+    since it was last seen, at most once every ttl seconds, and extended
+    with max_id requests only as far back as has been asked for. At most
+    max_statuses statuses are kept for each of the last max_users users.
+    """
+    #user_timeline returns at most this many statuses per request
+    page_size = 200
+
+    def __init__(self, limits, max_users=100, max_statuses=200, ttl=60):
+        self.limits = limits
+        self.max_users = max_users
+        self.max_statuses = max_statuses
+        self.ttl = ttl
+        self._timelines = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _timeline(self, screen_name):
+        """Returns the cached timeline for screen_name, creating it if needed"""
+        key = screen_name.lower()
+        with self._lock:
+            timeline = self._timelines.pop(key, None)
+            if timeline is None:
+                timeline = {'statuses': [], 'refreshed': 0, 'complete': False,
+                            'lock': threading.Lock()}
+            self._timelines[key] = timeline
+            while len(self._timelines) > self.max_users:
+                self._timelines.popitem(last=False)
+            return timeline
+
+    def _fetch(self, screen_name, count, **kwargs):
+        return self.limits.call('statuses/user_timeline', 'user_timeline',
+                                screen_name=screen_name, count=count,
+                                tweet_mode='extended', **kwargs)
+
+    def get(self, screen_name, index):
+        """
+        Returns the status at index (0 being the latest) in the timeline of
+        screen_name. Raises IndexError if there is no such status.
+        """
+        if index >= self.max_statuses:
+            raise IndexError('Only the latest %d statuses are available'
+                             % self.max_statuses)
+        timeline = self._timeline(screen_name)
+        with timeline['lock']:
+            statuses = timeline['statuses']
+            if not statuses:
+                statuses = list(self._fetch(screen_name,
+                                            min(max(index + 1, 20), self.page_size)))
+                timeline['complete'] = not statuses
+                timeline['refreshed'] = time.time()
+            elif timeline['refreshed'] < time.time() - self.ttl:
+                new = list(self._fetch(screen_name, self.page_size,
+                                       since_id=statuses[0].id))
+                if len(new) < self.page_size:
+                    statuses = new + statuses
+                else:
+                    # There may be a gap between the new and old statuses
+                    statuses = new
+                    timeline['complete'] = False
+                timeline['refreshed'] = time.time()
+            while len(statuses) <= index and not timeline['complete']:
+                older = list(self._fetch(screen_name, self.page_size,
+                                         max_id=statuses[-1].id - 1))
+                timeline['complete'] = not older
+                statuses.extend(older)
+            timeline['statuses'] = statuses[:self.max_statuses]
+            return timeline['statuses'][index]
+
+
+class RelayListener(tweepy.StreamListener):
+    """Passes the statuses received on the relay's stream to the relay"""
+    def __init__(self, relay):
+        tweepy.StreamListener.__init__(self)
+        self.relay = relay
+
+    def on_status(self, status):
+        self.relay.deliver(status)
+
+    def on_error(self, status_code):
+        # Disconnect; the relay reconnects after backing off
+        self.relay.last_error = status_code
+        return False
+
+
+class Relay(object):
+    """
+    Relays the statuses of followed accounts to IRC channels, using a single
+    streaming connection for all of them.
+
+    channels maps the lower-cased screen name of each followed account to
+    the channels to relay it to. The accounts are looked up by the relay's
+    thread, so that loading the module does not wait for Twitter; failed
+    lookups are retried with the same backoff as the stream. Statuses are
+    relayed once, even if the stream sends them again after a
+    reconnection. The stream is reconnected after an exponentially growing
+    delay, starting at a minute if Twitter asked us to slow down.
+    """
+    #Reconnection delays, in seconds
+    min_backoff = 5
+    rate_limited_backoff = 60
+    max_backoff = 15 * 60
+
+    def __init__(self, sopel, channels):
+        self.sopel = sopel
+        self.channels = channels
+        #ID of each followed account -> channels to relay it to
+        self.follows = {}
+        self.last_error = None
+        self.running = True
+        self._seen = TTLCache(1000, 24 * 3600)
+        self._stream = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def deliver(self, status):
+        """Says status in the channels of its author, unless it was already"""
+        channels = self.follows.get(status.user.id_str)
+        if not channels or self._seen.get(status.id_str):
+            return
+        self._seen.set(status.id_str, True)
+        line = cache_status(self.sopel, status)
+        if line is not None:
+            for channel in channels:
+                self.sopel.msg(channel, line)
+
+    def _resolve(self):
+        """Looks up the IDs of the followed accounts"""
+        limits = self.sopel.memory['twitter_limits']
+        names = list(self.channels)
+        follows = {}
+        for start in range(0, len(names), LOOKUP_BATCH_SIZE):
+            for user in limits.call('users/lookup', 'lookup_users',
+                                    screen_names=names[start:start + LOOKUP_BATCH_SIZE]):
+                remember_user(self.sopel, user)
+                follows[user.id_str] = self.channels[user.screen_name.lower()]
+        self.follows = follows
+
+    def _run(self):
+        backoff = 0
+        while self.running:
+            try:
+                self._resolve()
+                break
+            except RateLimited as e:
+                time.sleep(max(0, e.reset - time.time()))
+            except Exception:
+                backoff = max(backoff * 2, self.min_backoff)
+                time.sleep(min(backoff, self.max_backoff))
+        if not self.follows:
+            return
+        backoff = 0
+        while self.running:
+            self.last_error = None
+            self._stream = tweepy.Stream(self.sopel.memory['twitter_api'].auth,
+                                         RelayListener(self))
+            started = time.time()
+            try:
+                self._stream.filter(follow=list(self.follows))
+            except Exception:
+                pass
+            if not self.running:
+                break
+            if time.time() - started > self.max_backoff:
+                # The connection was healthy for a while, start over
+                backoff = 0
+            if self.last_error in (420, 429):
+                backoff = max(backoff * 2, self.rate_limited_backoff)
+            else:
+                backoff = max(backoff * 2, self.min_backoff)
+            time.sleep(min(backoff, self.max_backoff))
+
+    def stop(self):
+        """Disconnects the stream for good"""
+        self.running = False
+        if self._stream is not None:
+            self._stream.disconnect()
+
+
+def parse_relay(value):
+    """
+    Parses the relay option, e.g. "aplusk #chan1 #chan2, nasa #chan3", into
+    a dict mapping lower-cased screen names to lists of channels.
+    """
+    follows = {}
+    for entry in (value or '').split(','):
+        parts = entry.split()
+        if len(parts) > 1:
+            follows.setdefault(parts[0].lstrip('@').lower(), []).extend(parts[1:])
+    return follows
+
+
+def start_relay(sopel):
+    """
+    Starts relaying the accounts of the relay option.
+    """
+    sopel.memory['twitter_relay'] = Relay(sopel, parse_relay(sopel.config.twitter.relay))
+
+
+def create_api(config):
+    """
+    Returns an authenticated tweepy API object.
+    """
+    auth = tweepy.OAuthHandler(config.twitter.consumer_key, config.twitter.consumer_secret)
+    auth.set_access_token(config.twitter.access_token, config.twitter.access_token_secret)
+    return tweepy.API(auth)
+
+
 def setup(sopel):
+    if not sopel.config.has_option('twitter', 'status_cache_size'):
+        sopel.config.parser.set('twitter', 'status_cache_size', '1000')
+    if not sopel.config.has_option('twitter', 'status_cache_ttl'):
+        sopel.config.parser.set('twitter', 'status_cache_ttl', '3600')
+    if not sopel.config.has_option('twitter', 'profile_cache_size'):
+        sopel.config.parser.set('twitter', 'profile_cache_size', '1000')
+    if not sopel.config.has_option('twitter', 'profile_cache_ttl'):
+        sopel.config.parser.set('twitter', 'profile_cache_ttl', '3600')
+    if not sopel.config.has_option('twitter', 'timeline_users'):
+        sopel.config.parser.set('twitter', 'timeline_users', '100')
+    if not sopel.config.has_option('twitter', 'timeline_size'):
+        sopel.config.parser.set('twitter', 'timeline_size', '200')
+    if not sopel.config.has_option('twitter', 'timeline_ttl'):
+        sopel.config.parser.set('twitter', 'timeline_ttl', '60')
+    if not sopel.config.has_option('twitter', 'queue_size'):
+        sopel.config.parser.set('twitter', 'queue_size', '50')
+    sopel.memory['twitter_statuses'] = TTLCache(
+        int(sopel.config.twitter.status_cache_size),
+        float(sopel.config.twitter.status_cache_ttl))
+    # Each profile is stored under both its screen name and its ID
+    sopel.memory['twitter_profiles'] = TTLCache(
+        2 * int(sopel.config.twitter.profile_cache_size),
+        float(sopel.config.twitter.profile_cache_ttl))
     try:
-        auth = tweepy.OAuthHandler(sopel.config.twitter.consumer_key, willie.config.twitter.consumer_secret)
-        auth.set_access_token(sopel.config.twitter.access_token, willie.config.twitter.access_token_secret)
-        api = tweepy.API(auth)
+        sopel.memory['twitter_api'] = create_api(sopel.config)
     except:
         raise ConfigurationError('Could not authenticate with Twitter. Are the'
                                  ' API keys configured properly?')
-    regex = re.compile('twitter.com\/(\S*)\/status\/([\d]+)')
+    sopel.memory['twitter_limits'] = RateLimits(sopel.memory['twitter_api'])
+    sopel.memory['twitter_queue'] = FetchQueue(sopel.memory['twitter_limits'],
+                                               int(sopel.config.twitter.queue_size))
+    sopel.memory['twitter_timelines'] = TimelineCache(
+        sopel.memory['twitter_limits'],
+        int(sopel.config.twitter.timeline_users),
+        int(sopel.config.twitter.timeline_size),
+        float(sopel.config.twitter.timeline_ttl))
     if not sopel.memory.contains('url_callbacks'):
         sopel.memory['url_callbacks'] = tools.SopelMemory()
-    sopel.memory['url_callbacks'][regex] = gettweet
+    sopel.memory['url_callbacks'][status_regex] = gettweet
+    if sopel.config.twitter.relay:
+        start_relay(sopel)
+
+
+def shutdown(sopel):
+    relay = sopel.memory.get('twitter_relay')
+    if relay is not None:
+        relay.stop()
 
 
 def format_thousands(integer):
@@ -67,76 +516,222 @@ def tweet_url(status):
     """Returns a URL to Twitter for the given status object"""
     return 'https://twitter.com/' + status.user.screen_name + '/status/' + status.id_str
 
-@rule('.*twitter.com\/(\S*)\/status\/([\d]+).*')
-def gettweet(sopel, trigger, found_match=None):
-    """Show the last tweet by the given user"""
-    try:
-        auth = tweepy.OAuthHandler(sopel.config.twitter.consumer_key, willie.config.twitter.consumer_secret)
-        auth.set_access_token(sopel.config.twitter.access_token, willie.config.twitter.access_token_secret)
-        api = tweepy.API(auth)
+def render_status(status):
+    """
+    Returns the IRC line for the given status object, or None if it has no
+    text.
+    """
+    twituser = '@' + status.user.screen_name
 
-        if found_match:
-            status = api.get_status(found_match.group(2), tweet_mode='extended')
-        else:
-            parts = trigger.group(2).split()
-            if parts[0].isdigit():
-                status = api.get_status(parts[0], tweet_mode='extended')
-            else:
-                twituser = parts[0]
-                twituser = str(twituser)
-                statusnum = 0
-                if len(parts) > 1 and parts[1].isdigit():
-                    statusnum = int(parts[1]) - 1
-                status = api.user_timeline(twituser, tweet_mode='extended')[statusnum]
-        twituser = '@' + status.user.screen_name
-
-        # 280-char BS
+    # 280-char BS
+    try:
+        text = status.full_text
+    except:
         try:
-            text = status.full_text
+            text = status.text
         except:
-            try:
-                text = status.text
-            except:
-                return sopel.reply("I couldn't find the tweet text. :/")
+            return None
 
-        try:
-            for media in status.entities['media']:
-                text = text.replace(media['url'], media['media_url'])
-        except KeyError:
-            pass
-        try:
-            for url in status.entities['urls']:
-                text = text.replace(url['url'], url['expanded_url'])
-        except KeyError:
-            pass
-        sopel.say(twituser + ": " + str(text) + ' <' + tweet_url(status) + '>')
+    text = expand_entities(text, status.entities, MAX_TEXT_LENGTH)
+    return twituser + ": " + text + ' <' + tweet_url(status) + '>'
+
+def expand_entities(text, entities, max_length=None):
+    """
+    Returns text with its media and URL entities expanded, HTML entities
+    unescaped and newlines turned into spaces, cut to max_length characters.
+
+    The text is built in a single pass over the entities' indices, copying
+    each unchanged span once instead of the whole text per entity. An
+    entity whose indices do not match the text is looked for from the
+    current position instead, so that a URL appearing twice is never
+    replaced at the wrong place.
+    """
+    replacements = []
+    for media in entities.get('media', ()):
+        replacements.append((media['indices'], media['url'], media['media_url']))
+    for url in entities.get('urls', ()):
+        replacements.append((url['indices'], url['url'], url['expanded_url']))
+    replacements.sort()
+
+    pieces = []
+    position = 0
+    for (start, end), short, expanded in replacements:
+        if text[start:end] != short:
+            start = text.find(short, position)
+            if start < 0:
+                continue
+            end = start + len(short)
+        if start < position:
+            continue
+        piece = text[position:start]
+        pieces.append(unescape(piece) if '&' in piece else piece)
+        pieces.append(expanded)
+        position = end
+    piece = text[position:]
+    pieces.append(unescape(piece) if '&' in piece else piece)
+    text = u''.join(pieces).replace('\n', ' ')
+    if max_length is not None and len(text) > max_length:
+        text = text[:max_length - 1] + u'\u2026'
+    return text
+
+def cache_status(sopel, status):
+    """
+    Renders the given status object, and stores its line in the status
+    cache and its user in the profile cache.
+    Returns the rendered line.
+    """
+    remember_user(sopel, status.user)
+    line = render_status(status)
+    if line is not None:
+        sopel.memory['twitter_statuses'].set(status.id_str, line)
+    return line
+
+def remember_user(sopel, user):
+    """Stores a user object in the profile cache, by screen name and by ID"""
+    profiles = sopel.memory['twitter_profiles']
+    profiles.set(('name', user.screen_name.lower()), user)
+    profiles.set(('id', user.id_str), user)
+
+def get_user(sopel, twituser):
+    """
+    Returns the user object for a screen name or numeric ID, from the
+    profile cache if possible.
+    """
+    profiles = sopel.memory['twitter_profiles']
+    info = profiles.get(('name', twituser.lower()))
+    if info is None and twituser.isdigit():
+        info = profiles.get(('id', twituser))
+    if info is None:
+        info = sopel.memory['twitter_limits'].call(
+            'users/show', 'get_user', twituser)
+        remember_user(sopel, info)
+    return info
+
+def get_rendered_status(sopel, status_id):
+    """
+    Returns the IRC line for the given status ID, from the status cache if
+    possible.
+    """
+    cache = sopel.memory['twitter_statuses']
+    line = cache.get(status_id)
+    if line is None:
+        status = sopel.memory['twitter_limits'].call(
+            'statuses/show', 'get_status',
+            status_id, tweet_mode='extended')
+        line = cache_status(sopel, status)
+    return line
+
+def get_rendered_statuses(sopel, status_ids):
+    """
+    Returns the IRC lines for the given status IDs, in the same order.
+    Statuses which are not cached are fetched with as few statuses/lookup
+    requests as possible; the line of a status which could not be found
+    is None.
+    """
+    cache = sopel.memory['twitter_statuses']
+    lines = dict((status_id, cache.get(status_id)) for status_id in status_ids)
+    missing = [status_id for status_id in lines if lines[status_id] is None]
+    for start in range(0, len(missing), LOOKUP_BATCH_SIZE):
+        statuses = sopel.memory['twitter_limits'].call(
+            'statuses/lookup', 'statuses_lookup',
+            missing[start:start + LOOKUP_BATCH_SIZE], tweet_mode='extended')
+        for status in statuses:
+            lines[status.id_str] = cache_status(sopel, status)
+    return [lines.get(status_id) for status_id in status_ids]
+
+@rule('.*twitter.com\/(\S*)\/status\/([\d]+).*')
+def gettweets(sopel, trigger):
+    """Show every tweet linked to in the message, in order"""
+    status_ids = []
+    for match in status_regex.finditer(trigger):
+        if match.group(2) not in status_ids:
+            status_ids.append(match.group(2))
+
+    def say_tweets():
+        for line in get_rendered_statuses(sopel, status_ids):
+            if line is not None:
+                sopel.msg(trigger.sender, line)
+
+    try:
+        say_tweets()
+    except RateLimited as e:
+        sopel.memory['twitter_queue'].submit(e.endpoint, say_tweets)
+    except tweepy.TweepError:
+        pass
+gettweets.priority = 'medium'
+
+def defer(sopel, trigger, error, lookup):
+    """
+    Queues lookup, which returns the line to reply with, to run once the
+    rate limit which raised error has reset, and tells the user about it.
+    """
+    def reply():
+        sopel.msg(trigger.sender, trigger.nick + ': ' + lookup())
+
+    def failed():
+        sopel.msg(trigger.sender, trigger.nick + ': You have inputted an invalid user.')
+
+    if sopel.memory['twitter_queue'].submit(error.endpoint, reply, failed):
+        sopel.reply("Twitter's rate limit was reached, I'll answer at " +
+                    time.strftime('%H:%M', time.localtime(error.reset)) + '.')
+    else:
+        sopel.reply("Twitter's rate limit was reached, please try again later.")
+
+def lookup_tweet(sopel, args):
+    """
+    Returns the line for the .twit command with the given arguments: a
+    status ID, or a user and optionally the number of their tweet.
+    """
+    parts = args.split()
+    if parts[0].isdigit():
+        line = get_rendered_status(sopel, parts[0])
+    else:
+        twituser = parts[0]
+        twituser = str(twituser)
+        statusnum = 0
+        if len(parts) > 1 and parts[1].isdigit():
+            statusnum = int(parts[1]) - 1
+        status = sopel.memory['twitter_timelines'].get(twituser, statusnum)
+        line = cache_status(sopel, status)
+    if line is None:
+        return "I couldn't find the tweet text. :/"
+    return line
+
+def gettweet(sopel, trigger, found_match=None):
+    """Show the last tweet by the given user"""
+    args = found_match.group(2) if found_match else trigger.group(2)
+    try:
+        sopel.say(lookup_tweet(sopel, args))
+    except RateLimited as e:
+        defer(sopel, trigger, e, lambda: lookup_tweet(sopel, args))
     except:
         sopel.reply("You have inputted an invalid user.")
 gettweet.commands = ['twit']
 gettweet.priority = 'medium'
 gettweet.example = '.twit aplusk [tweetNum] or .twit 381982018927853568'
 
+def lookup_user(sopel, twituser):
+    """Returns the line describing the given Twitter account"""
+    info = get_user(sopel, twituser)
+    friendcount = format_thousands(info.friends_count)
+    name = info.name
+    id = info.id
+    favourites = info.favourites_count
+    followers = format_thousands(info.followers_count)
+    location = info.location
+    description = unescape(info.description)
+    return "@" + str(twituser) + ": " + str(name) + ". " + "ID: " + str(id) + ". Friend Count: " + friendcount + ". Followers: " + followers + ". Favourites: " + str(favourites) + ". Location: " + str(location) + ". Description: " + str(description)
+
 def f_info(sopel, trigger):
     """Show information about the given Twitter account"""
+    twituser = trigger.group(2)
+    twituser = str(twituser)
+    if '@' in twituser:
+        twituser = twituser.replace('@', '')
     try:
-        auth = tweepy.OAuthHandler(sopel.config.twitter.consumer_key, willie.config.twitter.consumer_secret)
-        auth.set_access_token(sopel.config.twitter.access_token, willie.config.twitter.access_token_secret)
-        api = tweepy.API(auth)
-
-        twituser = trigger.group(2)
-        twituser = str(twituser)
-        if '@' in twituser:
-            twituser = twituser.translate(None, '@')
-
-        info = api.get_user(twituser)
-        friendcount = format_thousands(info.friends_count)
-        name = info.name
-        id = info.id
-        favourites = info.favourites_count
-        followers = format_thousands(info.followers_count)
-        location = info.location
-        description = unescape(info.description)
-        sopel.reply("@" + str(twituser) + ": " + str(name) + ". " + "ID: " + str(id) + ". Friend Count: " + friendcount + ". Followers: " + followers + ". Favourites: " + str(favourites) + ". Location: " + str(location) + ". Description: " + str(description))
+        sopel.reply(lookup_user(sopel, twituser))
+    except RateLimited as e:
+        defer(sopel, trigger, e, lambda: lookup_user(sopel, twituser))
     except:
         sopel.reply("You have inputted an invalid user.")
 f_info.commands = ['twitinfo']
@@ -146,9 +741,7 @@ f_info.example = '.twitinfo aplsuk'
 def f_update(sopel, trigger):
     """Tweet with Sopel's account. Admin-only."""
     if trigger.admin:
-        auth = tweepy.OAuthHandler(sopel.config.twitter.consumer_key, willie.config.twitter.consumer_secret)
-        auth.set_access_token(sopel.config.twitter.access_token, willie.config.twitter.access_token_secret)
-        api = tweepy.API(auth)
+        api = sopel.memory['twitter_api']
 
         print(api.me().name)
 
@@ -164,9 +757,7 @@ f_update.priority = 'medium'
 f_update.example = '.tweet Hello World!'
 
 def f_reply(sopel, trigger):
-    auth = tweepy.OAuthHandler(sopel.config.twitter.consumer_key, willie.config.twitter.consumer_secret)
-    auth.set_access_token(sopel.config.twitter.access_token, willie.config.twitter.access_token_secret)
-    api = tweepy.API(auth)
+    api = sopel.memory['twitter_api']
 
     incoming = str(trigger.group(2))
     incoming = incoming.split()
@@ -186,5 +777,51 @@ def f_reply(sopel, trigger):
 f_reply.priority = 'medium'
 f_reply.example = '.reply 892379487 I like that idea!'
 
+def benchmark(count=10000):
+    """
+    Times expand_entities against the former replace-based expansion on a
+    corpus of entity-heavy tweets. The replace-based expansion is followed
+    by the same unescaping and cutting, so that both give the same result.
+    """
+    import random
+    import timeit
+
+    def replace_entities(text, entities):
+        for media in entities.get('media', ()):
+            text = text.replace(media['url'], media['media_url'])
+        for url in entities.get('urls', ()):
+            text = text.replace(url['url'], url['expanded_url'])
+        text = unescape(text).replace('\n', ' ')
+        if len(text) > MAX_TEXT_LENGTH:
+            text = text[:MAX_TEXT_LENGTH - 1] + u'\u2026'
+        return text
+
+    corpus = []
+    for i in range(200):
+        text = u''
+        entities = {'urls': [], 'media': []}
+        for j in range(random.randint(1, 8)):
+            text += random.choice((u'Look &amp; see ', u'so \u00e9l\u00e9gant ', u'a\nb '))
+            short = u'https://t.co/%08d' % (i * 10 + j)
+            entity = {'url': short, 'indices': [len(text), len(text) + len(short)]}
+            text += short + u' '
+            if j == 0 and i % 2:
+                entity['media_url'] = u'https://pbs.twimg.com/media/%d.jpg' % i
+                entities['media'].append(entity)
+            else:
+                entity['expanded_url'] = u'https://example.com/article/%d/%d' % (i, j)
+                entities['urls'].append(entity)
+        corpus.append((text, entities))
+
+    for name, render in (('str.replace', replace_entities),
+                         ('expand_entities', lambda text, entities:
+                              expand_entities(text, entities, MAX_TEXT_LENGTH))):
+        seconds = min(timeit.repeat(lambda: [render(text, entities) for text, entities in corpus],
+                                    number=count // len(corpus), repeat=3))
+        print('%-16s %8.2f us/tweet' % (name, seconds / count * 1e6))
+
 if __name__ == '__main__':
-    print(__doc__.strip())
+    if '--benchmark' in sys.argv:
+        benchmark()
+    else:
+        print(__doc__.strip())
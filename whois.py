@@ -11,10 +11,14 @@ other people, or can be imported and used by other modules.
 """
 
 from sopel.module import commands, event, rule
-from time import sleep
+from sopel.tools import Identifier
+from collections import OrderedDict
 from datetime import datetime, timedelta
+import threading
 
 AGE_THRESHOLD = timedelta(days=1)
+# How long a "no such nick" reply is remembered for
+NOT_FOUND_TTL = timedelta(seconds=5)
 
 class Whois(object):
 	def __init__(self, data):
@@ -40,68 +44,173 @@ class WhoisFailed(Exception):
 	pass
 
 
+class PendingWhois(object):
+	"""
+	A lookup waited for, completed by the reply handlers.
+	whois stays None if the server has no such nickname.
+	sent is set once the WHOIS has been written.
+	"""
+	def __init__(self):
+		self.done = threading.Event()
+		self.whois = None
+		self.sent = False
+
+
 def setup(bot):
-	bot.memory["whois"] = {}
+	if not bot.config.has_section("whois"):
+		bot.config.add_section("whois")
+	if not bot.config.has_option("whois", "timeout"):
+		bot.config.parser.set("whois", "timeout", "10")
+	if not bot.config.has_option("whois", "cache_size"):
+		bot.config.parser.set("whois", "cache_size", "1000")
+	# Oldest entries first, so that expiring them stops at the first fresh one
+	bot.memory["whois"] = OrderedDict()
+	bot.memory["whois_pending"] = {}
+	bot.memory["whois_lock"] = threading.Lock()
+	bot.memory["whois_coalesced"] = 0
+	# Nicks the server said do not exist, oldest first
+	bot.memory["whois_missing"] = OrderedDict()
+
+def configure(config):
+	"""
+	| [whois] | example | purpose |
+	| ------- | ------- | ------- |
+	| timeout | 10 | Seconds to wait for the server to reply to a WHOIS |
+	| cache_size | 1000 | Max. number of WHOIS replies kept |
+	"""
+	if config.option('Configure whois module', False):
+		config.interactive_add('whois', 'timeout',
+			"How many seconds should WHOIS lookups wait for the server?", '10')
 
 def _clear_old_entries(bot):
 	"""
 	Removes entries from the bot's memory which are older
-	than AGE_THRESHOLD.
-	"""
-	to_del = []
-	for nick, whois in bot.memory["whois"].items():
-		if whois.datetime < datetime.now() - AGE_THRESHOLD:
-			to_del.append(nick)
-	for nick in to_del:
-		try:
-			del bot.memory["whois"][nick]
-		except KeyError:
-			pass
+	than AGE_THRESHOLD. They are kept oldest first, so
+	only the expired ones are looked at.
+	"""
+	cache = bot.memory["whois"]
+	oldest = datetime.now() - AGE_THRESHOLD
+	with bot.memory["whois_lock"]:
+		while cache and next(iter(cache.values())).datetime < oldest:
+			cache.popitem(last=False)
+
+def _clear_missing(bot):
+	"""
+	Forgets the "no such nick" replies older than
+	NOT_FOUND_TTL. The caller holds the lock.
+	"""
+	missing = bot.memory["whois_missing"]
+	oldest = datetime.now() - NOT_FOUND_TTL
+	while missing and next(iter(missing.values())) < oldest:
+		missing.popitem(last=False)
+
+def _store(bot, nick, whois):
+	"""
+	Caches whois as the newest entry, dropping the oldest
+	ones beyond the cache size.
+	"""
+	cache = bot.memory["whois"]
+	with bot.memory["whois_lock"]:
+		cache.pop(nick, None)
+		cache[nick] = whois
+		while len(cache) > int(bot.config.whois.cache_size):
+			cache.popitem(last=False)
 
 def send_whois(bot, nick):
 	"""
 	Sends the WHOIS command to the server for the
-	specified nick.
+	specified nick, unless one is already in flight, in
+	which case this request is coalesced with it. Returns
+	the pending lookup.
 	"""
+	with bot.memory["whois_lock"]:
+		pending = bot.memory["whois_pending"].get(Identifier(nick))
+		if pending is not None and pending.sent:
+			bot.memory["whois_coalesced"] += 1
+			return pending
+		if pending is None:
+			pending = PendingWhois()
+			bot.memory["whois_pending"][Identifier(nick)] = pending
+		pending.sent = True
+		bot.memory["whois_missing"].pop(Identifier(nick), None)
 	bot.write(["WHOIS", nick])
+	return pending
 
-def get_whois(bot, nick):
+def get_whois(bot, nick, timeout=None):
 	"""
-	Waits for the response to be put into the bot's
-	memory by the receiving thread.
+	Waits for the receiving thread to complete the
+	lookup of nick, for at most timeout seconds (the
+	configured timeout by default).
 	"""
-	i = 0
-	while nick not in bot.memory["whois"] and i < 10:
-		i += 1
-		sleep(1)
-	
-	if nick not in bot.memory["whois"]:
+	with bot.memory["whois_lock"]:
+		pending = bot.memory["whois_pending"].get(Identifier(nick))
+		if pending is None:
+			cached = bot.memory["whois"].get(Identifier(nick))
+			if cached is not None:
+				return cached
+			# The server may already have said there is no such nick
+			_clear_missing(bot)
+			if Identifier(nick) in bot.memory["whois_missing"]:
+				raise WhoisFailed("No such nickname")
+			pending = bot.memory["whois_pending"][Identifier(nick)] = PendingWhois()
+	return _wait(bot, nick, pending, timeout)
+
+def _wait(bot, nick, pending, timeout):
+	"""
+	Waits for pending, the lookup of nick, to complete.
+	"""
+	if timeout is None:
+		timeout = float(bot.config.whois.timeout)
+	if not pending.done.wait(timeout):
+		with bot.memory["whois_lock"]:
+			if bot.memory["whois_pending"].get(Identifier(nick)) is pending:
+				del bot.memory["whois_pending"][Identifier(nick)]
 		raise WhoisFailed("No reply from server")
-	elif bot.memory["whois"][nick] is None:
-		try:
-			del bot.memory["whois"][nick]
-		except KeyError:
-			pass
+	if pending.whois is None:
 		raise WhoisFailed("No such nickname")
 
 	# A little housekeeping
 	_clear_old_entries(bot)
 
-	return bot.memory["whois"][nick]
+	return pending.whois
 
-def whois(bot, nick):
+def whois(bot, nick, timeout=None, max_age=None):
 	"""
 	Sends the WHOIS command to the server then waits for
-	the response to be put into the bot's memory by the
-	receiving thread.
+	the response to be handed over by the receiving
+	thread.
+
+	If max_age (a timedelta or a number of seconds) is
+	given, a cached response at most that old is returned
+	without asking the server again.
 	"""
+	if max_age is not None:
+		if not isinstance(max_age, timedelta):
+			max_age = timedelta(seconds=max_age)
+		_clear_old_entries(bot)
+		cached = bot.memory["whois"].get(Identifier(nick))
+		if cached is not None and cached.datetime >= datetime.now() - max_age:
+			return cached
 	# Remove entry first so that we get the latest
-	try:
-		del bot.memory["whois"][nick]
-	except KeyError:
-		pass
-	send_whois(bot, nick)
-	return get_whois(bot, nick)
+	with bot.memory["whois_lock"]:
+		bot.memory["whois"].pop(Identifier(nick), None)
+	return _wait(bot, nick, send_whois(bot, nick), timeout)
+
+def _complete(bot, nick, whois=None):
+	"""
+	Completes the pending lookup of nick, if any. It is
+	handed whois, or is ended if whois is None.
+	"""
+	with bot.memory["whois_lock"]:
+		if whois is None:
+			pending = bot.memory["whois_pending"].pop(Identifier(nick), None)
+		else:
+			pending = bot.memory["whois_pending"].get(Identifier(nick))
+			bot.memory["whois_missing"].pop(Identifier(nick), None)
+	if pending is not None:
+		if whois is not None:
+			pending.whois = whois
+		pending.done.set()
 
 @rule(r".*")
 @event("311")
@@ -110,24 +219,44 @@ def whois_found_reply(bot, trigger):
 	Listens for successful WHOIS responses and saves
 	them to the bot's memory.
 	"""
-	nick = trigger.args[1]
-	bot.memory["whois"][nick] = Whois(trigger.args)
+	nick = Identifier(trigger.args[1])
+	whois = Whois(trigger.args)
+	_store(bot, nick, whois)
+	_complete(bot, nick, whois)
 
 @rule(r".*")
 @event("401")
 def whois_not_found_reply(bot, trigger):
 	"""
-	Listens for unsuccessful WHOIS responses and saves
-	None to the bot's memory so that the initial
-	whois function is aware that the lookup failed.
+	Listens for unsuccessful WHOIS responses and ends
+	the pending lookup, so that the initial whois
+	function is aware that the lookup failed. The failure
+	is remembered for NOT_FOUND_TTL, for a get_whois
+	called after the reply came in.
 	"""
-	nick = trigger.args[1]
-	bot.memory["whois"][nick] = None
+	with bot.memory["whois_lock"]:
+		_clear_missing(bot)
+		bot.memory["whois_missing"].pop(Identifier(trigger.args[1]), None)
+		bot.memory["whois_missing"][Identifier(trigger.args[1])] = datetime.now()
+	_complete(bot, trigger.args[1])
 
-	# Give the initiating whois function time to see
-	# that the lookup has failed, then remove the None.
-	sleep(5)
-	try:
-		del bot.memory["whois"][nick]
-	except KeyError:
-		pass
\ No newline at end of file
+@rule(r".*")
+@event("318")
+def whois_end_reply(bot, trigger):
+	"""
+	Listens for the end of WHOIS responses and ends
+	the pending lookup, whether or not it was found.
+	"""
+	_complete(bot, trigger.args[1])
+
+@commands("whoisstats")
+def whoisstats(bot, trigger):
+	"""
+	Reports the number of cached and pending WHOIS
+	lookups, and how many requests joined a lookup
+	already in flight.
+	"""
+	bot.say("[whois] %d cached, %d pending, %d requests coalesced" % (
+		len(bot.memory["whois"]),
+		len(bot.memory["whois_pending"]),
+		bot.memory["whois_coalesced"]))